@@ -0,0 +1,38 @@
+import sys
+import json
+import argparse
+
+
+# Stage by stage comparison of two run_bench.py reports.
+
+
+def main(args):
+    with open(args.base) as fh:
+        base = json.load(fh)
+    with open(args.new) as fh:
+        new = json.load(fh)
+    if base['scale'] != new['scale'] or base['seed'] != new['seed']:
+        sys.exit('The reports were run on different inputs.')
+
+    print(f'{base["scale"]} (seed {base["seed"]}): {base.get("commit")} -> {new.get("commit")}')
+    print(f'{"stage":<24}{"wall base":>11}{"wall new":>11}{"ratio":>8}{"rss base":>10}{"rss new":>10}')
+    for stage, b in base['stages'].items():
+        n = new['stages'].get(stage)
+        if n is None:
+            continue
+        ratio = n['wall_s'] / b['wall_s'] if b['wall_s'] else float('nan')
+        flag = ''
+        if b['items_out'] != n['items_out']:
+            flag = f'  output changed: {b["items_out"]} -> {n["items_out"]}'
+        print(f'{stage:<24}{b["wall_s"]:>11.3f}{n["wall_s"]:>11.3f}{ratio:>8.2f}'
+            f'{b["peak_rss_mb"]:>10.0f}{n["peak_rss_mb"]:>10.0f}{flag}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares two benchmark reports.')
+    parser.add_argument('base', help='Report of the reference commit')
+    parser.add_argument('new', help='Report of the commit under test')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import solo_gRNA
+from libs.genome_store import open_genome
+from libs.intervals import IntervalIndex
+from libs.hit_table import load_hits
+from libs.metrics import StageRecorder, rss_mb
+
+from synth import SCALES, make_inputs
+
+
+# Times the stages of the solo pipeline on synthetic inputs (see synth.py).
+# Each stage runs in a fresh interpreter so its peak RSS is its own; inputs
+# are loaded before the clock starts. Results go to a JSON file that
+# compare.py diffs between commits. No bowtie binary is needed, the hits
+# are generated.
+#
+#   python bench/run_bench.py --scale small --out small.json
+#   python bench/compare.py base.json small.json
+
+STAGES = ['enumerate_rrna_regions', 'grna_miner', 'exon_positions', 'load_hits',
+    'discard_for_offtarget', 'discard_for_dimer', 'clapse_by_density']
+PAM = 'NGG'
+
+
+def guides_of(files, n=None):
+    guides = {_id: str(seq) for _id, seq in solo_gRNA.read_guids(files['guides.fa']).items()}
+    if n is not None:
+        guides = dict(list(guides.items())[:n])
+    return guides
+
+def setup(stage, files, params):
+    #returns the call to time, its input item count and a function
+    #counting the items of its result
+    if stage == 'enumerate_rrna_regions':
+        return (lambda: solo_gRNA.enumerate_rrna_regions(files['genome.fa'], files['rrna.bed']),
+            params['rrna'], lambda res: sum(len(seqs) for seqs in res[0].values()))
+    if stage == 'grna_miner':
+        rRNA_genes, positions, genome_seqs = solo_gRNA.enumerate_rrna_regions(files['genome.fa'], files['rrna.bed'])
+        return (lambda: solo_gRNA.grna_miner(rRNA_genes, PAM), sum(len(seqs) for seqs in rRNA_genes.values()), len)
+    if stage == 'exon_positions':
+        #no cache directory, the GTF is parsed every time
+        return (lambda: solo_gRNA.exon_positions(files['genes.gtf'], cache_dir=None), params['genes'],
+            lambda res: sum(len(res.starts[s]) for s in res.scaffolds()))
+    if stage == 'load_hits':
+        return lambda: load_hits(files['hits.csv']), params['hits'], len
+
+    guides = guides_of(files)
+    if stage == 'discard_for_offtarget':
+        rRNA_genes, positions, genome_seqs = solo_gRNA.enumerate_rrna_regions(files['genome.fa'], files['rrna.bed'])
+        rrna_index = IntervalIndex(positions)
+        exon_index = solo_gRNA.exon_positions(files['genes.gtf'], cache_dir=None)
+        hits = load_hits(files['hits.csv'])
+        return (lambda: solo_gRNA.discard_for_offtarget(hits, genome_seqs, rrna_index, exon_index, guides, PAM),
+            len(hits), len)
+    if stage == 'discard_for_dimer':
+        guides = guides_of(files, params['dimer'])
+        return lambda: solo_gRNA.discard_for_dimer(guides), len(guides), len
+    if stage == 'clapse_by_density':
+        hits = load_hits(files['hits.csv'])
+        return lambda: solo_gRNA.clapse_by_density(guides, hits), len(hits), len
+    raise ValueError(f'unknown stage {stage}')
+
+def run_stage(stage, scale, seed, workdir):
+    #runs in the child interpreter, returns the stage record
+    files = make_inputs(workdir, scale, seed)
+    rundir = os.path.join(workdir, f'{scale}.{seed}.run')
+    os.makedirs(rundir, exist_ok=True)
+    os.chdir(rundir)
+    recorder = StageRecorder()
+    with redirect_stdout(sys.stderr):
+        call, items_in, count = setup(stage, files, SCALES[scale])
+        rss_before = rss_mb()
+        with recorder.stage(stage, items_in=items_in) as rec:
+            rec['items_out'] = count(call())
+    rec['rss_growth_mb'] = round(rec['peak_rss_mb'] - rss_before, 1)
+    return rec
+
+def git_commit():
+    res = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    return res.stdout.strip() if res.returncode == 0 else None
+
+def main(args):
+    if args.stage:
+        json.dump(run_stage(args.stage, args.scale, args.seed, args.workdir), sys.stdout)
+        return
+
+    #inputs and the genome store are built once, outside any timing
+    files = make_inputs(args.workdir, args.scale, args.seed)
+    open_genome(files['genome.fa']).close()
+
+    report = {'scale': args.scale, 'seed': args.seed, 'params': SCALES[args.scale], 'commit': git_commit(),
+        'python': platform.python_version(), 'machine': platform.machine(), 'stages': {}}
+    for stage in args.stages or STAGES:
+        runs = []
+        for _ in range(args.repeat):
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--stage', stage,
+                '--scale', args.scale, '--seed', str(args.seed), '--workdir', args.workdir],
+                stdout=subprocess.PIPE, text=True, check=True)
+            runs.append(json.loads(out.stdout))
+        #fastest repeat, with the highest peak RSS seen
+        best = min(runs, key=lambda run: run['wall_s'])
+        best['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+        report['stages'][stage] = best
+        print(f'{stage}: {best["wall_s"]:.3f} s wall, {best["cpu_s"]:.3f} s cpu, '
+            f'{best["peak_rss_mb"]:.0f} MB peak, {best["items_in"]} -> {best["items_out"]}')
+
+    with open(args.out, 'w') as fo:
+        json.dump(report, fo, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the solo pipeline stages on synthetic inputs.')
+    parser.add_argument('--scale', default='tiny', choices=list(SCALES),
+                        help='Input size (Default: tiny).')
+    parser.add_argument('--seed', default=1, type=int,
+                        help='Seed of the synthetic inputs (Default: 1).')
+    parser.add_argument('--workdir', default='bench_data', type=str,
+                        help='Directory of the generated inputs, reused across runs (Default: bench_data).')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=None,
+                        help='Stages to run (Default: all).')
+    parser.add_argument('--repeat', default=1, type=int,
+                        help='Runs per stage, the fastest is reported (Default: 1).')
+    parser.add_argument('--out', default='bench.json', type=str,
+                        help='JSON report (Default: bench.json).')
+    parser.add_argument('--stage', default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    args.workdir = os.path.abspath(args.workdir)
+
+    main(args)
@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+
+
+# Deterministic synthetic inputs for the solo pipeline benchmarks: a random
+# genome, a GTF of exons, an rRNA BED in the layout of rRNA_regions.bed, and
+# bowtie hits (as written with --suppress 6,7) for a set of guides. The same
+# scale and seed always give the same files.
+
+SCALES = {
+    #scaffolds, scaffold length, rRNA regions, genes, guides, hits, dimer oligos
+    'tiny':   dict(scaffolds=4,  length=500_000,    rrna=24,  genes=2_000,   guides=500,    hits=100_000,    dimer=200),
+    'small':  dict(scaffolds=8,  length=2_500_000,  rrna=96,  genes=20_000,  guides=5_000,  hits=1_000_000,  dimer=1_000),
+    'medium': dict(scaffolds=16, length=12_500_000, rrna=384, genes=60_000,  guides=20_000, hits=5_000_000,  dimer=2_000),
+    'large':  dict(scaffolds=24, length=40_000_000, rrna=768, genes=120_000, guides=50_000, hits=20_000_000, dimer=4_000),
+}
+
+RRNA_LENGTHS = {'5S': 120, 'SSU': 1870, 'LSU': 5070, 'MT': 950}
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def scaffold_names(n):
+    return [f'chr{i+1}' for i in range(n)]
+
+def write_genome(fname, rng, scaffolds, length, width=60):
+    with open(fname, 'wb') as fh:
+        for name in scaffold_names(scaffolds):
+            fh.write(f'>{name} synthetic\n'.encode())
+            for start in range(0, length, 1 << 22):
+                block = BASES[rng.integers(0, 4, min(1 << 22, length - start))]
+                rows = len(block) // width
+                lines = np.hstack([block[:rows*width].reshape(rows, width),
+                    np.full((rows, 1), ord('\n'), dtype=np.uint8)])
+                fh.write(lines.tobytes())
+                if len(block) % width:
+                    fh.write(block[rows*width:].tobytes() + b'\n')
+
+def write_rrna_bed(fname, rng, scaffolds, length, n):
+    names = scaffold_names(scaffolds)
+    types = list(RRNA_LENGTHS)
+    with open(fname, 'w') as fh:
+        fh.write('chrom\tstart\tend\tstrand\tlength\tname\tname\n')
+        for i in range(n):
+            rrna = types[i % len(types)]
+            size = RRNA_LENGTHS[rrna]
+            scaffold = names[int(rng.integers(scaffolds))]
+            start = int(rng.integers(0, length - size))
+            strand = '+-'[int(rng.integers(2))]
+            fh.write(f'{scaffold}\t{start}\t{start+size}\t{strand}\t{size}\t{rrna}\t{rrna}_dup{i}\n')
+
+def write_gtf(fname, rng, scaffolds, length, genes):
+    #genes of 1-8 exons, one gene and its exon lines per gene
+    names = scaffold_names(scaffolds)
+    with open(fname, 'w') as fh:
+        fh.write('#!genome-build synthetic\n')
+        for i in range(genes):
+            scaffold = names[int(rng.integers(scaffolds))]
+            n = int(rng.integers(1, 9))
+            sizes = rng.integers(50, 400, n)
+            gaps = rng.integers(100, 3000, n)
+            start = int(rng.integers(1, max(2, length - int(sizes.sum() + gaps.sum()))))
+            end = start + int(sizes.sum() + gaps[:-1].sum())
+            strand = '+-'[int(rng.integers(2))]
+            fh.write(f'{scaffold}\tsynth\tgene\t{start}\t{end}\t.\t{strand}\t.\tgene_id "G{i}";\n')
+            pos = start
+            for size, gap in zip(sizes.tolist(), gaps.tolist()):
+                fh.write(f'{scaffold}\tsynth\texon\t{pos}\t{pos+size-1}\t.\t{strand}\t.\tgene_id "G{i}";\n')
+                pos += size + gap
+
+def write_guides(fname, rng, ids, guide_length=20):
+    codes = rng.integers(0, 4, (len(ids), guide_length))
+    with open(fname, 'w') as fh:
+        for _id, row in zip(ids, BASES[codes]):
+            fh.write(f'>{_id}\n{row.tobytes().decode()}\n')
+
+def write_hits(fname, rng, ids, scaffolds, length, n, guide_length=20, chunk=1_000_000):
+    #half of the hits are spread uniformly, half cluster in hot spots so the
+    #density collapse has work to do. Hit counts per guide are skewed, so
+    #some guides have no true off-target
+    names = np.array(scaffold_names(scaffolds))
+    hot = rng.integers(0, length - 10_000, 64)
+    spacer = 'A' * guide_length
+    with open(fname, 'w') as fh:
+        for done in range(0, n, chunk):
+            k = min(chunk, n - done)
+            guide = (len(ids) * rng.random(k) ** 4).astype(np.int64)
+            scaffold = rng.integers(0, scaffolds, k)
+            pos = np.where(rng.random(k) < 0.5, rng.integers(0, length - guide_length, k),
+                hot[rng.integers(0, len(hot), k)] + rng.integers(0, 10_000, k))
+            strand = rng.integers(0, 2, k)
+            mismatches = rng.integers(0, 4, k)
+            lines = []
+            for g, s, p, st, mm in zip(guide.tolist(), scaffold.tolist(), pos.tolist(),
+                    strand.tolist(), mismatches.tolist()):
+                mm_str = ','.join(f'{j}:A>C' for j in range(mm))
+                lines.append(f'{ids[g]}\t{"+-"[st]}\t{names[s]}\t{p}\t{spacer}\t{mm_str}\n')
+            fh.write(''.join(lines))
+
+def make_inputs(workdir, scale='tiny', seed=1):
+    #writes the inputs of one scale into workdir (skipping files already
+    #there) and returns their paths
+    params = SCALES[scale]
+    os.makedirs(workdir, exist_ok=True)
+    files = {name: os.path.join(workdir, f'{scale}.{seed}.{name}') for name in
+        ('genome.fa', 'rrna.bed', 'genes.gtf', 'guides.fa', 'hits.csv')}
+    #one generator per file, so each file only depends on scale and seed
+    rngs = {name: np.random.default_rng([seed, i]) for i, name in enumerate(files)}
+    if not os.path.isfile(files['genome.fa']):
+        write_genome(files['genome.fa'], rngs['genome.fa'], params['scaffolds'], params['length'])
+    if not os.path.isfile(files['rrna.bed']):
+        write_rrna_bed(files['rrna.bed'], rngs['rrna.bed'], params['scaffolds'], params['length'], params['rrna'])
+    if not os.path.isfile(files['genes.gtf']):
+        write_gtf(files['genes.gtf'], rngs['genes.gtf'], params['scaffolds'], params['length'], params['genes'])
+    ids = [f'g{i}' for i in range(params['guides'])]
+    if not os.path.isfile(files['guides.fa']):
+        write_guides(files['guides.fa'], rngs['guides.fa'], ids)
+    if not os.path.isfile(files['hits.csv']):
+        write_hits(files['hits.csv'], rngs['hits.csv'], ids, params['scaffolds'], params['length'], params['hits'])
+    return files
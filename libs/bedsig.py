@@ -1,15 +1,27 @@
 import os
 import re
 import sys
+import gzip
+import shutil
+import random
+import hashlib
 
-from uuid import uuid4
-from random import random, randint, choice
+import numpy as np
+import pysam
+
+from multiprocessing import Pool
 from collections import defaultdict
 from bisect import bisect_right, insort_left
 
 from .utils import read_config
 from .process_bin import random_bins
+from .faidx import FastaIndex
 
+VAR_PATTERN = re.compile(r'(\d+)([ATCG]+)')
+#suffix of the merged output per compression
+COMPRESS_EXT = {'none': '', 'gzip': '.gz', 'bgzip': '.gz'}
+#empty block closing a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
 
 
 
@@ -38,8 +50,16 @@ class SimSeq:
         self.n = int(self.config['n'])
         self.snps = self.config['SNPdb']
         self.add_snp = self.config['addSNP']
+        self.compress = args.compress or self.config.get('compress', 'none')
+        if self.compress not in COMPRESS_EXT:
+            sys.exit(f'Unknown compression {self.compress}, use one of {", ".join(COMPRESS_EXT)}')
+        #master seed, every chromosome gets its own generator derived from it
+        self.seed = args.seed if args.seed is not None else self.config.get('seed')
+        if self.seed is None:
+            self.seed = random.SystemRandom().randrange(1 << 32)
+            print(f'Simulating with seed {self.seed}')
         fbed = self.config['rRNA_interval']
-        self.random_intervals = random_bins(fbed)
+        self.random_intervals = random_bins(fbed, rng=random.Random(f'{self.seed}:bins'))
         self.load_snps()
 
     def load_snps(self):
@@ -68,81 +88,115 @@ class SimSeq:
                 res.append((chrom, str(pos)))
         return res
 
-    def seq_with_var(self, read, region, pos, snp_info):
-        pattern = re.compile(r'(\d+)([ATCG]+)')
-        ref, alt, freq = snp_info
-        pos = int(pos)
-
-        m = pattern.search(alt)
-        alt_pos = pos - region[0] - 1
-
-        # SNP or deletion
-        if m is None:
-            try:
-                # deletion
-                tmp = int(alt)
-                new_read = read[0:alt_pos] + read[alt_pos+len(ref):]
-            except ValueError:
-                new_read = read[0:alt_pos] + alt + read[alt_pos+1:]
-        # multi alts
-        else:
-            alt = m.group(2)
-            new_read = read[0:alt_pos] + alt + read[alt_pos+len(alt):]
-
-        return new_read
-
-    def worker(self):
-        fh = open('mock.fa', 'w')
-        for chrom, seq in fa_parser(self.fa):
-            try:
-                regions = self.random_intervals[chrom]
-                if not regions:
-                    continue
-                for region in regions:
-                    snps = self.snps_in_region(chrom, region)
-                    read = seq[region[0]:region[1]]
-                    #read_reverse = read_rc(read)
-                    if self.add_snp == 'False':
-                        for i in range(self.n):
-                            seq_id = gen_seq_id(chrom, region)
-                            fh.write(f'>{seq_id}\n{read}\n')
-                            #fh.write(f'>{seq_id}_rc\n{read_reverse}\n')
-                    else:
-                        if not snps:
-                            for i in range(self.n):
-                                seq_id = gen_seq_id(chrom, region)
-                                fh.write(f'>{seq_id}\n{read}\n')
-                                #fh.write(f'>{seq_id}_rc\n{read_reverse}\n')
-                        else:
-                            snp = choice(snps)
-                            _, pos = snp
-                            snp_info = choice(self.snp_db[snp])
-                            freq = float(snp_info[2])
-                            output_read = self.seq_with_var(read, region, pos, snp_info)
-                            #print(region)
-                            #print(pos, snp_info)
-
-                            for i in range(self.n):
-                                prob = random()
-                                if prob < freq:
-                                    out_read = self.seq_with_var(read, region, pos, snp_info)
-                                else:
-                                    out_read = read
-
-                                #read_reverse = read_rc(out_read)
-                                seq_id = gen_seq_id(chrom, region)
-                                fh.write(f'>{seq_id}\n{out_read}\n')
-                                #fh.write(f'>{seq_id}_rc\n{read_reverse}\n')
-            except KeyError:
+    def jobs(self, shard_dir):
+        #one job per chromosome with regions: the region sequences, read
+        #through the FASTA index, and the SNPs found in them, so workers
+        #need neither genome nor SNP db
+        fasta = FastaIndex(self.fa)
+        i = 0
+        for chrom in fasta.names:
+            regions = self.random_intervals.get(chrom)
+            if not regions:
                 continue
+            items = []
+            for region in regions:
+                snps = self.snps_in_region(chrom, region)
+                if self.add_snp == 'False':
+                    snps = []
+                items.append((region, fasta.fetch(chrom, region[0], region[1]),
+                    [(snp, self.snp_db[snp]) for snp in snps]))
+            yield (chrom, items, self.n, f'{self.seed}:{chrom}', os.path.join(shard_dir, f'{i:05d}.fa'),
+                self.compress)
+            i += 1
+        fasta.close()
 
-        fh.close()
-
-def gen_seq_id(chrom, region):
-    num = randint(1000, 3000)
-    string = str(uuid4())
-    string_seg, *tmp = string.split('-')
-    return f'{chrom}_{region[0]}_{region[1]}_{num}{string_seg}'
+    def worker(self):
+        #chromosomes are simulated in parallel into shards, merged into
+        #mock.fa in genome order. Compressed shards are whole gzip members or
+        #BGZF blocks, so merging them stays a plain concatenation
+        shard_dir = 'mock_shards'
+        os.makedirs(shard_dir, exist_ok=True)
+        with open(f'mock.fa{COMPRESS_EXT[self.compress]}', 'wb') as fo:
+            if self.p > 1:
+                with Pool(processes=self.p) as pool:
+                    for shard in pool.imap(simulate, self.jobs(shard_dir)):
+                        merge_shard(shard, fo, self.compress)
+            else:
+                for job in self.jobs(shard_dir):
+                    merge_shard(simulate(job), fo, self.compress)
+            if self.compress == 'bgzip':
+                fo.write(BGZF_EOF)
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+def seed_of(seed):
+    #64 bit integer seed of a derived seed string such as '7:chr1'
+    return int.from_bytes(hashlib.sha256(str(seed).encode()).digest()[:8], 'little')
+
+def open_shard(shard, compress):
+    if compress == 'gzip':
+        return gzip.open(shard, 'wb', compresslevel=6)
+    if compress == 'bgzip':
+        return pysam.BGZFile(shard, 'wb')
+    return open(shard, 'wb')
+
+def simulate(job):
+    #n reads per region, carrying one of the region's SNPs (if any) at its
+    #allele frequency. Read IDs are chrom_start_end_k with k counting the
+    #reads of the chromosome. Writes the shard and returns its path
+    chrom, items, n, seed, shard, compress = job
+    rng = np.random.default_rng(seed_of(seed))
+    k = 0
+    with open_shard(shard, compress) as fh:
+        for region, read, snps in items:
+            prefix = f'>{chrom}_{region[0]}_{region[1]}_'
+            ref_tail = f'\n{read}\n'
+            if not snps:
+                block = ''.join([f'{prefix}{i}{ref_tail}' for i in range(k, k + n)])
+            else:
+                snp, infos = snps[rng.integers(len(snps))]
+                _, pos = snp
+                snp_info = infos[rng.integers(len(infos))]
+                var_tail = f'\n{seq_with_var(read, region, pos, snp_info)}\n'
+                tails = (ref_tail, var_tail)
+                has_var = (rng.random(n) < float(snp_info[2])).tolist()
+                block = ''.join([f'{prefix}{i}{tails[v]}' for i, v in zip(range(k, k + n), has_var)])
+            k += n
+            fh.write(block.encode())
+    return shard
+
+def merge_shard(shard, fo, compress='none'):
+    with open(shard, 'rb') as fh:
+        if compress == 'bgzip':
+            #drop the shard's own EOF block, one is written after the last shard
+            data = fh.read()
+            if data.endswith(BGZF_EOF):
+                data = data[:-len(BGZF_EOF)]
+            fo.write(data)
+        else:
+            shutil.copyfileobj(fh, fo)
+    os.remove(shard)
+
+def seq_with_var(read, region, pos, snp_info):
+    ref, alt, freq = snp_info
+    pos = int(pos)
+
+    m = VAR_PATTERN.search(alt)
+    alt_pos = pos - region[0] - 1
+
+    # SNP or deletion
+    if m is None:
+        try:
+            # deletion
+            tmp = int(alt)
+            new_read = read[0:alt_pos] + read[alt_pos+len(ref):]
+        except ValueError:
+            new_read = read[0:alt_pos] + alt + read[alt_pos+1:]
+    # multi alts
+    else:
+        alt = m.group(2)
+        new_read = read[0:alt_pos] + alt + read[alt_pos+len(alt):]
+
+    return new_read
 
 def read_rc(read):
     base_pairs = {
@@ -1,11 +1,16 @@
 import os
 import sys
+import csv
+import heapq
 import argparse
 from multiprocessing import Pool
 
+import pysam
+
 from .utils import read_config
 from .process_bin import BinBuilder
 from .process_bam import BamParser
+from .coverage import open_coverage, read_intervals
 
 
 class Scanner:
@@ -13,8 +18,22 @@ class Scanner:
         fcfg = args.cfg
         self.config = read_config(fcfg)
         self.p = args.p
-
-        self.fh = open('rRNA_dep_rate2.tsv', 'w')
+        self.chunk = args.chunk
+        self.cache_dir = args.cache
+        self.compress = not args.plain
+        self.echo = args.echo
+
+        #rows are written in coordinate order, straight into the bgzipped
+        #rRNA_dep_rate2.tsv.gz (tabix indexed at the end) unless plain text
+        #is asked for. Bins of overlapping intervals wait in pending until
+        #no later chunk can start before them
+        if self.compress:
+            self.out = 'rRNA_dep_rate2.tsv.gz'
+            self.fh = pysam.BGZFile(self.out, 'wb')
+        else:
+            self.out = 'rRNA_dep_rate2.tsv'
+            self.fh = open(self.out, 'wb')
+        self.pending = []
         
         bam_dir = self.config['bam_dir']
 
@@ -27,63 +46,195 @@ class Scanner:
         self.ref_ratio = 1 - float(ref_rRNA_ratio)
         self.del_ratio = 1 - float(del_rRNA_ratio)
 
+        #binning and read filter, optional in the config
+        self.bin_len = int(self.config.get('bin_len') or 100)
+        self.overlap = int(self.config.get('overlap') or 50)
+        self.maxSoftClip = int(self.config.get('maxSoftClip') or 50)
+        self.count_mode = self.config.get('count_mode') or 'all'
+
     def rbatch(self):
+        if self.cache_dir:
+            self.cached_batch()
+            return
+
         bam_con = BamParser(self.bam_ref)
         bam_del = BamParser(self.bam_del)
 
-        self.ref_reads = self.config['ref_reads'] or bam_con.total_reads()
-        self.del_reads = self.config['del_reads'] or bam_del.total_reads()
+        self.ref_reads = self.config['ref_reads'] or bam_con.total_reads(self.count_mode)
+        self.del_reads = self.config['del_reads'] or bam_del.total_reads(self.count_mode)
         bam_con.close()
         bam_del.close()
 
-        bin_obj = BinBuilder(self.config['rRNA_interval'])
-        regions = bin_obj.interval_batch(self.p)
-
-        pool = Pool(processes=self.p)
-        results = []
-        for region in regions:
-            results.append(pool.apply_async(func=scanner, args=(self.bam_ref, self.bam_del, region,)))
-        pool.close()
-        pool.join()
-
-        for res in results:
-            self.recorder(res.get())
-
-        self.fh.close()
+        #small chunks handed out as workers free up, rows written in bin
+        #order as soon as all earlier chunks are done
+        bin_obj = BinBuilder(self.config['rRNA_interval'], self.bin_len, self.overlap)
+        chunks = bin_obj.chunks(self.chunk)
+
+        initargs = ([self.bam_ref, self.bam_del], self.maxSoftClip)
+        with Pool(processes=self.p, initializer=open_parsers, initargs=initargs) as pool:
+            for rows in ordered_imap(pool, count_chunk, chunks):
+                self.recorder(rows)
+
+        self.finish()
+
+    def cached_batch(self):
+        #bins counted from the coverage caches of both samples, which are
+        #built (one pass over each BAM) when missing
+        bed = self.config['rRNA_interval']
+        args = [(self.cache_dir, bam, bed, CACHE_PAD, self.count_mode) for bam in (self.bam_ref, self.bam_del)]
+        if self.p > 1:
+            with Pool(processes=2) as pool:
+                cov_con, cov_del = pool.starmap(open_coverage, args)
+        else:
+            cov_con, cov_del = [open_coverage(*arg) for arg in args]
+
+        self.ref_reads = self.config['ref_reads'] or cov_con.total_reads
+        self.del_reads = self.config['del_reads'] or cov_del.total_reads
+
+        for region in sorted(read_intervals(bed)):
+            chrom, start, end = region
+            counts_con = cov_con.bin_counts(region, self.bin_len, self.overlap, self.maxSoftClip)
+            counts_del = cov_del.bin_counts(region, self.bin_len, self.overlap, self.maxSoftClip)
+            bin_starts = range(start, end, self.overlap)
+            self.recorder([[chrom, s, s + self.bin_len, n_con, n_del] for s, n_con, n_del
+                in zip(bin_starts, counts_con.tolist(), counts_del.tolist())])
+
+        self.finish()
 
     def recorder(self, results):
+        #results are the rows of one chunk, chunks come in the order of their
+        #first bin, so every pending row before that bin is final
+        if results:
+            self.write_rows(tuple(results[0][:3]))
         for res in results:
-            arr = res
-            *region ,n_con, n_del = res
-            fpkm_con = fpkm(n_con, int(self.ref_reads))
-            fpkm_del = fpkm(n_del, int(self.del_reads))
+            heapq.heappush(self.pending, tuple(res))
+
+    def write_rows(self, until=None):
+        #writes the pending rows before until, all of them without it
+        lines = []
+        while self.pending and (until is None or self.pending[0][:3] < until):
+            *region ,n_con, n_del = heapq.heappop(self.pending)
+            fpkm_con = fpkm(n_con, int(self.ref_reads), self.bin_len)
+            fpkm_del = fpkm(n_del, int(self.del_reads), self.bin_len)
             fpkm_con_normed = self.normalize(fpkm_con)
 
             ratio = del_ratio(fpkm_con_normed, fpkm_del)
 
-            arr.extend([fpkm_con_normed, fpkm_del, ratio])
+            chrom, start, end = region
+            lines.append(f'{chrom}\t{start}\t{end}\t{n_con}\t{n_del}\t{fpkm_con_normed:.4f}\t{fpkm_del:.4f}\t{ratio:.6f}\n')
+        block = ''.join(lines)
+        self.fh.write(block.encode())
+        if self.echo:
+            sys.stdout.write(block)
 
-            arr_out = list(map(str, arr))
-            print(arr_out)
-            self.fh.write('\t'.join(arr_out) + '\n')
+    def finish(self):
+        self.write_rows()
+        self.fh.close()
+        if self.compress:
+            #<out>.tbi next to the bgzipped rows
+            pysam.tabix_index(self.out, force=True, preset='bed')
 
     def normalize(self, fpkm_con):
         return fpkm_con * self.del_ratio / self.ref_ratio
 
-def scanner(bam_con, bam_del, region):
-    results =[]
+#padding of the coverage caches, the longest bin they can count is one more
+CACHE_PAD = 1000
 
-    bam_con_parser = BamParser(bam_con)
-    bam_del_parser = BamParser(bam_del)
 
-    for bin_ in region:
-        n_con = bam_con_parser.bin_count(bin_)
-        n_del = bam_del_parser.bin_count(bin_)
-        print(bin_ + [n_con, n_del])
-        results.append(bin_ + [n_con, n_del])
-    bam_con_parser.close()
-    bam_del_parser.close()
-    return results
+class DepMatrix:
+    #bins x samples matrices of counts, normalized FPKM and depletion
+    #ratios, counting every sample in one parallel pass over the bins
+    def __init__(self, args):
+        self.config = read_config(args.cfg)
+        self.p = args.p
+        self.chunk = args.chunk
+        self.prefix = args.o
+
+        self.bin_len = int(self.config.get('bin_len') or 100)
+        self.overlap = int(self.config.get('overlap') or 50)
+        self.maxSoftClip = int(self.config.get('maxSoftClip') or 50)
+        self.count_mode = self.config.get('count_mode') or 'all'
+
+        self.samples = read_sample_sheet(args.sheet, self.config.get('bam_dir') or '')
+        names = [sample['sample'] for sample in self.samples]
+        self.depleted = []
+        for i, sample in enumerate(self.samples):
+            if sample['control']:
+                if sample['control'] not in names:
+                    raise ValueError(f"Control {sample['control']} of {sample['sample']} is not in the sample sheet")
+                self.depleted.append((i, names.index(sample['control'])))
+
+    def rbatch(self):
+        for sample in self.samples:
+            if not sample['reads']:
+                bam = BamParser(sample['bam'])
+                sample['reads'] = bam.total_reads(self.count_mode)
+                bam.close()
+
+        bin_obj = BinBuilder(self.config['rRNA_interval'], self.bin_len, self.overlap)
+        chunks = bin_obj.chunks(self.chunk)
+
+        names = [sample['sample'] for sample in self.samples]
+        header = ['chrom', 'start', 'end']
+        fh_counts = open(f'{self.prefix}.counts.tsv', 'w')
+        fh_fpkm = open(f'{self.prefix}.fpkm.tsv', 'w')
+        fh_ratio = open(f'{self.prefix}.ratio.tsv', 'w')
+        fh_counts.write('\t'.join(header + names) + '\n')
+        fh_fpkm.write('\t'.join(header + names) + '\n')
+        fh_ratio.write('\t'.join(header + [names[i] for i, _ in self.depleted]) + '\n')
+
+        initargs = ([sample['bam'] for sample in self.samples], self.maxSoftClip)
+        with Pool(processes=self.p, initializer=open_parsers, initargs=initargs) as pool:
+            for rows in ordered_imap(pool, count_chunk, chunks):
+                for row in rows:
+                    region, counts = row[:3], row[3:]
+                    normed = [fpkm(n, int(sample['reads']), self.bin_len) / (1 - sample['rRNA_ratio'])
+                        for n, sample in zip(counts, self.samples)]
+                    ratios = [del_ratio(normed[c], normed[d]) if normed[c] else float('nan')
+                        for d, c in self.depleted]
+                    bin_ = '\t'.join(map(str, region))
+                    fh_counts.write(bin_ + '\t' + '\t'.join(map(str, counts)) + '\n')
+                    fh_fpkm.write(bin_ + '\t' + '\t'.join(map(str, normed)) + '\n')
+                    fh_ratio.write(bin_ + '\t' + '\t'.join(map(str, ratios)) + '\n')
+
+        fh_counts.close()
+        fh_fpkm.close()
+        fh_ratio.close()
+
+def read_sample_sheet(sheet, bam_dir=''):
+    #tab-separated with a header: sample, bam, rRNA_ratio and optionally
+    #reads (total reads, counted from the BAM when empty) and control (the
+    #sample a depleted library is compared with, empty for controls)
+    samples = []
+    with open(sheet) as fh:
+        for row in csv.DictReader((line for line in fh if not line.startswith('#')), delimiter='\t'):
+            samples.append({'sample': row['sample'], 'bam': os.path.join(bam_dir, row['bam']),
+                'rRNA_ratio': float(row['rRNA_ratio']), 'reads': int(row.get('reads') or 0),
+                'control': row.get('control') or ''})
+    return samples
+
+#BAM handles of a pool worker, opened once and used for all its chunks
+parsers = []
+
+def open_parsers(bams, maxSoftClip=50):
+    parsers.extend(BamParser(bam, maxSoftClip) for bam in bams)
+
+def count_chunk(job):
+    #each bin followed by its count in every BAM
+    i, region = job
+    counts = [parser.region_count(region) for parser in parsers]
+    return i, [bin_ + list(bin_counts) for bin_, *bin_counts in zip(region, *counts)]
+
+def ordered_imap(pool, func, chunks):
+    #results of func over the chunks in chunk order, the chunks being
+    #handed out as workers free up
+    pending = {}
+    next_chunk = 0
+    for i, rows in pool.imap_unordered(func, enumerate(chunks)):
+        pending[i] = rows
+        while next_chunk in pending:
+            yield pending.pop(next_chunk)
+            next_chunk += 1
 
 def del_ratio(fpkm_con, fpkm_del):
     return (fpkm_con - fpkm_del)/fpkm_con
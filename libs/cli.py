@@ -2,7 +2,7 @@ import os
 import sys
 import argparse
 
-from .bin_scanner import Scanner
+from .bin_scanner import Scanner, DepMatrix
 from .bedsig import SimSeq
 
 
@@ -26,9 +26,35 @@ def _dep_rate(args):
 Dep_rate = AP_subparsers.add_parser('deprate', help=_dep_rate.__doc__)
 Dep_rate.add_argument('-cfg', metavar='config', help='Config file, refer to example for details', required=True)
 Dep_rate.add_argument('-p', metavar='process', help='Number of processor, default=4', default=4, type=int)
+Dep_rate.add_argument('-chunk', metavar='bins', help='Bins per work unit handed to a processor, default=64', default=64, type=int)
+Dep_rate.add_argument('-cache', metavar='dir', help='Directory of per-sample coverage caches. They are built on first use,\n'
+    'later runs count the bins from them without reading the BAMs,\nwhatever bin_len, overlap and maxSoftClip are set to', default=None)
+Dep_rate.add_argument('-plain', help='Write rRNA_dep_rate2.tsv as plain text instead of a bgzipped and\n'
+    'tabix-indexed rRNA_dep_rate2.tsv.gz. Rows are in coordinate order either way', action='store_true')
+Dep_rate.add_argument('-echo', help='Also print every row to stdout', action='store_true')
 Dep_rate.set_defaults(func=_dep_rate)
 
 
+######################################################################################
+##### Depletion matrix of many samples
+######################################################################################
+def _dep_matrix(args):
+    """Count the bins of every sample of a sample sheet in one pass and write
+     bins x samples matrices of counts, normalized FPKM and depletion ratios."""
+    matrix = DepMatrix(args)
+    matrix.rbatch()
+
+Dep_matrix = AP_subparsers.add_parser('depmatrix', help=_dep_matrix.__doc__)
+Dep_matrix.add_argument('-cfg', metavar='config', help='Config file with rRNA_interval and optionally bam_dir,\n'
+    'bin_len, overlap, maxSoftClip and count_mode', required=True)
+Dep_matrix.add_argument('-sheet', metavar='samples', help='Tab-separated sample sheet with a header: sample, bam,\n'
+    'rRNA_ratio and optionally reads and control', required=True)
+Dep_matrix.add_argument('-o', metavar='prefix', help='Output prefix, default=rRNA_dep', default='rRNA_dep')
+Dep_matrix.add_argument('-p', metavar='process', help='Number of processor, default=4', default=4, type=int)
+Dep_matrix.add_argument('-chunk', metavar='bins', help='Bins per work unit handed to a processor, default=64', default=64, type=int)
+Dep_matrix.set_defaults(func=_dep_matrix)
+
+
 ######################################################################################
 ##### Simulating reads
 ######################################################################################
@@ -42,6 +68,10 @@ def _mock_seqs(args):
 Mock = AP_subparsers.add_parser('mock', help=_mock_seqs.__doc__)
 Mock.add_argument('-cfg', metavar='config', help='Config file, refer to example for details', required=True)
 Mock.add_argument('-p', metavar='process', help='Number of processor, default=4', default=1, type=int)
+Mock.add_argument('-seed', metavar='seed', help='Master seed of the simulation, overrides seed in the config.\n'
+    'Runs with the same seed give the same reads for any -p', default=None)
+Mock.add_argument('-compress', metavar='compress', help='Compression of the output: none (mock.fa), gzip or bgzip\n'
+    '(mock.fa.gz), overrides compress in the config. Default: none', default=None, choices=['none', 'gzip', 'bgzip'])
 Mock.set_defaults(func=_mock_seqs)
 
 
@@ -0,0 +1,164 @@
+import os
+import hashlib
+
+import numpy as np
+import pysam
+
+from .process_bam import BamParser, process_CIGAR
+
+
+# Per-sample cache of the reads over the rRNA intervals: the CIGAR blocks
+# (process_CIGAR) and largest soft clip of every read, grouped by merged
+# interval. Bin counts for any bin length, overlap and soft clip cutoff are
+# then computed from the cache with the same rule as BamParser.valid_read,
+# without reading the BAM again. Intervals are padded by pad bp on the right
+# since the last bins of an interval run past its end; bins longer than
+# pad + 1 need a cache built with a larger pad.
+
+
+def read_intervals(bed):
+    intervals = []
+    with open(bed) as fh:
+        for line in fh:
+            if line.startswith('@'):
+                continue
+            arr = line.split()
+            intervals.append((arr[0], int(arr[1]), int(arr[2])))
+    return intervals
+
+def merge_intervals(intervals, pad):
+    #(chrom, start, end) groups covering every interval extended by pad
+    groups = []
+    for chrom, start, end in sorted((c, s, e + pad) for c, s, e in intervals):
+        if groups and groups[-1][0] == chrom and start <= groups[-1][2]:
+            groups[-1][2] = max(groups[-1][2], end)
+        else:
+            groups.append([chrom, start, end])
+    return groups
+
+def cache_file(cache_dir, bam, bed, pad, count_mode):
+    #named after the BAM and keyed on its path, size and mtime, the bed and
+    #the settings the cache depends on
+    h = hashlib.sha1()
+    for fname in (bam, bed):
+        st = os.stat(fname)
+        h.update(f'{os.path.abspath(fname)}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+    h.update(f'{pad}:{count_mode}'.encode())
+    return os.path.join(cache_dir, f'{os.path.basename(bam)}.{h.hexdigest()[:16]}.cov.npz')
+
+
+class Coverage:
+    def __init__(self, chroms, starts, ends, read_off, block_off, block_start, block_end, soft_clip,
+            pad, total_reads):
+        self.chroms = list(chroms)
+        self.starts = starts
+        self.ends = ends
+        self.read_off = read_off #group -> first read
+        self.block_off = block_off #read -> first block
+        self.block_start = block_start
+        self.block_end = block_end
+        self.soft_clip = soft_clip #largest soft clip of each read
+        self.pad = pad
+        self.total_reads = total_reads
+
+    @classmethod
+    def build(cls, bam, bed, pad=1000, count_mode='all'):
+        #one fetch per merged interval, one process_CIGAR per read
+        groups = merge_intervals(read_intervals(bed), pad)
+        read_off = [0]
+        block_off = [0]
+        block_start = []
+        block_end = []
+        soft_clip = []
+        with pysam.AlignmentFile(bam, 'rb') as bamfile:
+            for chrom, start, end in groups:
+                for read in bamfile.fetch(chrom, start, end):
+                    r_blocks, soft_clippings = process_CIGAR(read.pos, read.cigar)
+                    soft_clip.append(max(soft_clippings, default=0))
+                    for bs, be in r_blocks:
+                        block_start.append(bs)
+                        block_end.append(be)
+                    block_off.append(len(block_start))
+                read_off.append(len(soft_clip))
+        parser = BamParser(bam)
+        total_reads = parser.total_reads(count_mode)
+        parser.close()
+        return cls([g[0] for g in groups], np.array([g[1] for g in groups], dtype=np.int64),
+            np.array([g[2] for g in groups], dtype=np.int64), np.array(read_off, dtype=np.int64),
+            np.array(block_off, dtype=np.int64), np.array(block_start, dtype=np.int64),
+            np.array(block_end, dtype=np.int64), np.array(soft_clip, dtype=np.int32), pad, total_reads)
+
+    def save(self, fname):
+        tmp = f'{fname}.tmp'
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, chroms=np.array(self.chroms, dtype=str), starts=self.starts, ends=self.ends,
+                read_off=self.read_off, block_off=self.block_off, block_start=self.block_start,
+                block_end=self.block_end, soft_clip=self.soft_clip,
+                meta=np.array([self.pad, self.total_reads], dtype=np.int64))
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            pad, total_reads = data['meta'].tolist()
+            return cls(data['chroms'].tolist(), data['starts'], data['ends'], data['read_off'],
+                data['block_off'], data['block_start'], data['block_end'], data['soft_clip'],
+                pad, total_reads)
+
+    def group(self, chrom, start, end):
+        for g, (c, s, e) in enumerate(zip(self.chroms, self.starts.tolist(), self.ends.tolist())):
+            if c == chrom and s <= start and end <= e:
+                return g
+        raise KeyError(f'{chrom}:{start}-{end} is not covered by the cache')
+
+    def bin_counts(self, region, bin_len=100, overlap=50, maxSoftClip=50):
+        #counts of the bins BinBuilder.splitter makes from region, as
+        #BamParser.bin_count would give them
+        chrom, start, end = region
+        n_bins = len(range(start, end, overlap))
+        if n_bins == 0:
+            return np.zeros(0, dtype=np.int64)
+        if bin_len > self.pad + 1:
+            raise ValueError(f'Bins of {bin_len} bp need a coverage cache padded by at least {bin_len - 1} bp')
+        g = self.group(chrom, start, end)
+
+        #blocks of the reads passing the soft clip cutoff
+        reads = np.arange(self.read_off[g], self.read_off[g+1])
+        reads = reads[self.soft_clip[reads] <= maxSoftClip]
+        first = self.block_off[reads]
+        n_blocks = self.block_off[reads + 1] - first
+        read = np.repeat(reads, n_blocks)
+        blocks = np.repeat(first - np.cumsum(n_blocks) + n_blocks, n_blocks) + np.arange(n_blocks.sum())
+        bs = self.block_start[blocks]
+        be = self.block_end[blocks]
+
+        #every (block, bin) pair where the bin starts inside (bs - bin_len, be)
+        k_lo = np.clip(-((start - bs + bin_len - 1) // overlap), 0, n_bins)
+        k_hi = np.clip((be - 1 - start) // overlap, -1, n_bins - 1)
+        n = np.maximum(k_hi - k_lo + 1, 0)
+        idx = np.repeat(np.arange(len(bs)), n)
+        k = k_lo[idx] + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        b_s = bs[idx]
+        b_e = be[idx]
+        s = start + k * overlap
+        e = s + bin_len
+
+        #valid_read: a block counts when it overlaps more than half of the
+        #bin, except a block covering the whole bin
+        m_len = np.where(b_s > s, np.minimum(e, b_e) - b_s, b_e - np.maximum(b_s, s))
+        ok = ~((b_s > e) | (b_e < s)) & ((b_e < e) | (b_s > s)) & (m_len * 2 > bin_len)
+
+        #each read counts once per bin
+        pairs = np.unique(read[idx][ok] * n_bins + k[ok])
+        return np.bincount(pairs % n_bins, minlength=n_bins)
+
+
+def open_coverage(cache_dir, bam, bed, pad=1000, count_mode='all'):
+    #loads the cache of bam, building it on first use
+    fname = cache_file(cache_dir, bam, bed, pad, count_mode)
+    if os.path.isfile(fname):
+        return Coverage.load(fname)
+    os.makedirs(cache_dir, exist_ok=True)
+    coverage = Coverage.build(bam, bed, pad, count_mode)
+    coverage.save(fname)
+    return coverage
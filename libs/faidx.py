@@ -0,0 +1,114 @@
+import os
+import hashlib
+
+
+# Random access to a FASTA through a samtools-style .fai index (name,
+# length, offset, bases per line, bytes per line), built when missing or
+# older than the FASTA. The index is written next to the FASTA, or, when
+# that is not writable, in the working directory under a name hashed from
+# the FASTA's path, with the FASTA's size and mtime on a first '#' line.
+# Sequences can be looked up by their name with 'chr' removed, as fa_parser
+# names them.
+
+
+def normalize(name):
+    return name.replace('chr', '')
+
+def fasta_stamp(fa):
+    st = os.stat(fa)
+    return f'#{os.path.abspath(fa)}\t{st.st_size}\t{st.st_mtime_ns}\n'
+
+def build_fai(fa, fai, stamp=None):
+    entries = []
+    with open(fa, 'rb') as fh:
+        offset = 0
+        entry = None
+        last_line = False
+        for line in fh:
+            if line.startswith(b'>'):
+                if entry:
+                    entries.append(entry)
+                name = line[1:].split()[0].decode()
+                entry = [name, 0, offset + len(line), 0, 0]
+                last_line = False
+            elif entry is not None and line.strip():
+                bases = len(line.rstrip(b'\r\n'))
+                if entry[3] == 0:
+                    entry[3] = bases
+                    entry[4] = len(line)
+                #a full line without its newline can only end the file
+                elif last_line or bases > entry[3] or (bases == entry[3] and len(line) != entry[4]
+                        and line.endswith(b'\n')):
+                    raise ValueError(f'{fa}: lines of {name} differ in length, it cannot be indexed')
+                last_line = bases < entry[3]
+                entry[1] += bases
+            offset += len(line)
+        if entry:
+            entries.append(entry)
+    tmp = f'{fai}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as fo:
+        if stamp:
+            fo.write(stamp)
+        for entry in entries:
+            fo.write('\t'.join(map(str, entry)) + '\n')
+    os.replace(tmp, fai)
+
+
+class FastaIndex:
+    def __init__(self, fa):
+        self.fa = fa
+        self.entries = {} #normalized name -> (length, offset, line bases, line bytes)
+        self.names = [] #normalized names in genome order
+        fai = self.index_file()
+        with open(fai) as fh:
+            for line in fh:
+                if line.startswith('#'):
+                    continue
+                name, length, offset, line_bases, line_bytes = line.split('\t')[:5]
+                name = normalize(name)
+                if name not in self.entries:
+                    self.names.append(name)
+                    self.entries[name] = (int(length), int(offset), int(line_bases), int(line_bytes))
+        self.fh = open(fa, 'rb')
+
+    def index_file(self):
+        #an up to date .fai of the FASTA, built if needed
+        fai = f'{self.fa}.fai'
+        if os.path.isfile(fai) and os.path.getmtime(fai) >= os.path.getmtime(self.fa):
+            return fai
+        try:
+            build_fai(self.fa, fai)
+            return fai
+        except OSError:
+            #not writable, e.g. a read-only file system
+            pass
+        key = hashlib.sha1(os.path.abspath(self.fa).encode()).hexdigest()[:16]
+        fai = f'{os.path.basename(self.fa)}.{key}.fai'
+        stamp = fasta_stamp(self.fa)
+        if os.path.isfile(fai):
+            with open(fai) as fh:
+                if fh.readline() == stamp:
+                    return fai
+        build_fai(self.fa, fai, stamp)
+        return fai
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def length(self, name):
+        return self.entries[name][0]
+
+    def fetch(self, name, start, end):
+        #sequence[start:end] of name, with Python slice semantics
+        length, offset, line_bases, line_bytes = self.entries[name]
+        start, end, _ = slice(start, end).indices(length)
+        if end <= start:
+            return ''
+        first = offset + (start // line_bases) * line_bytes + start % line_bases
+        last = offset + ((end - 1) // line_bases) * line_bytes + (end - 1) % line_bases
+        self.fh.seek(first)
+        raw = self.fh.read(last - first + 1)
+        return raw.replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def close(self):
+        self.fh.close()
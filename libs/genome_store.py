@@ -0,0 +1,164 @@
+import os
+import mmap
+import fcntl
+import hashlib
+
+import numpy as np
+
+
+# Packed genome store: one byte per base, upper-cased, scaffolds concatenated
+# in FASTA order into <prefix>.seq, with an offset table in <prefix>.idx
+# (scaffold, offset, length). The .seq file is memory mapped, so slicing a
+# scaffold only touches the pages that are actually read.
+# The .idx is written last and starts with the size and mtime of the .seq it
+# belongs to, so a store cut short between the two files is rebuilt. Builds
+# hold a lock, concurrent jobs build only once. The default store sits next
+# to the FASTA, or in the working directory when that is not writable.
+
+
+def store_prefix(genome_fa, prefix=None):
+    return prefix or f'{genome_fa}.gstore'
+
+def local_prefix(genome_fa):
+    #store in the working directory, named after the FASTA's path
+    key = hashlib.sha1(os.path.abspath(genome_fa).encode()).hexdigest()[:16]
+    return f'{os.path.basename(genome_fa)}.{key}.gstore'
+
+def seq_stamp(seq_file):
+    st = os.stat(seq_file)
+    return f'#seq\t{st.st_size}\t{st.st_mtime_ns}\n'
+
+def store_is_current(genome_fa, prefix):
+    seq_file = f'{prefix}.seq'
+    idx_file = f'{prefix}.idx'
+    if not (os.path.isfile(seq_file) and os.path.isfile(idx_file)):
+        return False
+    fa_mtime = os.path.getmtime(genome_fa)
+    if os.path.getmtime(seq_file) < fa_mtime or os.path.getmtime(idx_file) < fa_mtime:
+        return False
+    with open(idx_file) as fh:
+        return fh.readline() == seq_stamp(seq_file)
+
+def build_store(genome_fa, prefix):
+    #streams the fasta line by line, so no chromosome is ever held in memory.
+    #Temporary files are private to the process; the .seq is moved into
+    #place first, the .idx naming it last
+    seq_tmp = f'{prefix}.seq.{os.getpid()}.tmp'
+    idx_tmp = f'{prefix}.idx.{os.getpid()}.tmp'
+    offset = 0
+    scaffold = None
+    length = 0
+    rows = []
+    with open(genome_fa, 'rb') as fh, open(seq_tmp, 'wb') as fs:
+        for line in fh:
+            if line.startswith(b'>'):
+                if scaffold is not None:
+                    rows.append(f'{scaffold}\t{offset}\t{length}\n')
+                    offset += length
+                scaffold = line[1:].split()[0].decode()
+                length = 0
+            else:
+                seq = line.rstrip().upper()
+                fs.write(seq)
+                length += len(seq)
+        if scaffold is not None:
+            rows.append(f'{scaffold}\t{offset}\t{length}\n')
+    os.replace(seq_tmp, f'{prefix}.seq')
+    with open(idx_tmp, 'w') as fi:
+        fi.write(seq_stamp(f'{prefix}.seq'))
+        fi.writelines(rows)
+    os.replace(idx_tmp, f'{prefix}.idx')
+    return prefix
+
+def ensure_store(genome_fa, prefix):
+    if store_is_current(genome_fa, prefix):
+        return prefix
+    with open(f'{prefix}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not store_is_current(genome_fa, prefix):
+            build_store(genome_fa, prefix)
+    return prefix
+
+def open_genome(genome_fa, prefix=None):
+    #opens the packed store of genome_fa, building it first if it is missing
+    #or older than the fasta
+    if prefix:
+        return GenomeStore(ensure_store(genome_fa, prefix))
+    try:
+        return GenomeStore(ensure_store(genome_fa, store_prefix(genome_fa)))
+    except OSError:
+        #not writable next to the fasta, e.g. a read-only file system
+        return GenomeStore(ensure_store(genome_fa, local_prefix(genome_fa)))
+
+
+class Scaffold:
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.length)
+            if step != 1:
+                raise ValueError('Scaffold slices do not support a step')
+            if end <= start:
+                return ''
+            return self.buf[self.offset+start:self.offset+end].decode()
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('Scaffold index out of range')
+        return chr(self.buf[self.offset+key])
+
+    def __str__(self):
+        return self[:]
+
+
+class GenomeStore:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.scaffolds = {}
+        with open(f'{prefix}.idx') as fh:
+            if fh.readline() != seq_stamp(f'{prefix}.seq'):
+                raise ValueError(f'{prefix}.idx does not belong to {prefix}.seq, the store needs a rebuild')
+            for line in fh:
+                scaffold, offset, length = line.split('\t')
+                self.scaffolds[scaffold] = (int(offset), int(length))
+        self.fh = open(f'{prefix}.seq', 'rb')
+        if os.path.getsize(f'{prefix}.seq'):
+            self.buf = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buf = b''
+
+    def __contains__(self, scaffold):
+        return scaffold in self.scaffolds
+
+    def __getitem__(self, scaffold):
+        offset, length = self.scaffolds[scaffold]
+        return Scaffold(self.buf, offset, length)
+
+    def __iter__(self):
+        return iter(self.scaffolds)
+
+    def __len__(self):
+        return len(self.scaffolds)
+
+    def keys(self):
+        return self.scaffolds.keys()
+
+    def fetch(self, scaffold, start, end):
+        return self[scaffold][start:end]
+
+    def array(self, scaffold):
+        #zero-copy uint8 view of one scaffold
+        offset, length = self.scaffolds[scaffold]
+        return np.frombuffer(self.buf, dtype=np.uint8, count=length, offset=offset)
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.fh.close()
@@ -0,0 +1,79 @@
+import os
+import zlib
+import sqlite3
+import hashlib
+
+from .hit_table import HitTableBuilder
+
+
+# On-disk verdicts per spacer, so reruns only screen guides never seen before.
+# Off-target hits and verdicts depend on the genome, index, annotation, rRNA
+# regions and PAM, and are keyed by a fingerprint of all of them; primer
+# dimer verdicts only depend on the oligo and the Tm cutoffs.
+
+
+def fingerprint(*items):
+    #files are identified by path, size and mtime, anything else by its value
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, str) and os.path.isfile(item):
+            st = os.stat(item)
+            item = f'{os.path.abspath(item)}:{st.st_size}:{st.st_mtime_ns}'
+        digest.update(f'{item}\n'.encode())
+    return digest.hexdigest()
+
+
+class GuideCache:
+    def __init__(self, path, key=''):
+        self.key = key
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS offtarget (key TEXT, spacer TEXT, '
+            'discard INTEGER, hits BLOB, PRIMARY KEY (key, spacer))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dimer (oligo TEXT, het_tm REAL, end_tm REAL, '
+            'discard INTEGER, PRIMARY KEY (oligo, het_tm, end_tm))')
+
+    def offtarget_lookup(self, spacers):
+        #spacer:(discard, [(forward, scaffold, pos, mismatches)])
+        found = dict()
+        for spacer in set(spacers):
+            row = self.db.execute('SELECT discard, hits FROM offtarget WHERE key=? AND spacer=?',
+                (self.key, spacer)).fetchone()
+            if row is None:
+                continue
+            hits = []
+            for line in zlib.decompress(row[1]).decode().splitlines():
+                strand, scaffold, pos, mismatches = line.split('\t')
+                hits.append((strand == '+', scaffold, int(pos), int(mismatches)))
+            found[spacer] = (bool(row[0]), hits)
+        return found
+
+    def offtarget_store(self, spacer, discard, hits):
+        #hits as (forward, scaffold, pos, mismatches)
+        blob = zlib.compress(''.join(f'{"+" if forward else "-"}\t{scaffold}\t{pos}\t{mm}\n'
+            for forward, scaffold, pos, mm in hits).encode())
+        self.db.execute('INSERT OR REPLACE INTO offtarget VALUES (?, ?, ?, ?)',
+            (self.key, spacer, int(discard), blob))
+
+    def cached_hits(self, guides, found):
+        #hit table of the guides whose spacer was found in the cache
+        builder = HitTableBuilder()
+        for _id, spacer in guides.items():
+            for forward, scaffold, pos, mismatches in found[spacer][1]:
+                builder.add(_id, forward, scaffold, pos, mismatches)
+        return builder.table()
+
+    def dimer_lookup(self, oligo, het_tm, end_tm):
+        row = self.db.execute('SELECT discard FROM dimer WHERE oligo=? AND het_tm=? AND end_tm=?',
+            (oligo, het_tm, end_tm)).fetchone()
+        return None if row is None else bool(row[0])
+
+    def dimer_store(self, oligo, het_tm, end_tm, discard):
+        self.db.execute('INSERT OR REPLACE INTO dimer VALUES (?, ?, ?, ?)',
+            (oligo, het_tm, end_tm, int(discard)))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
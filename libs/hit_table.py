@@ -0,0 +1,145 @@
+import os
+from array import array
+from itertools import islice
+
+import numpy as np
+
+
+# Bowtie hits (run with --suppress 6,7) parsed once into columnar arrays:
+# guide id index, strand, scaffold code, 0-based position and mismatch count.
+
+HIT_CHUNK = 1_000_000 #hits per table when parsing a running search
+
+
+class HitTable:
+    def __init__(self, guide_ids, scaffolds, guide, forward, scaffold, pos, mismatches):
+        self.guide_ids = list(guide_ids) #guide index -> read name
+        self.scaffolds = list(scaffolds) #scaffold code -> scaffold name
+        self.guide = guide
+        self.forward = forward
+        self.scaffold = scaffold
+        self.pos = pos
+        self.mismatches = mismatches
+
+    def __len__(self):
+        return len(self.pos)
+
+    def take(self, rows):
+        #table of the given rows, codes unchanged
+        return HitTable(self.guide_ids, self.scaffolds, self.guide[rows], self.forward[rows],
+            self.scaffold[rows], self.pos[rows], self.mismatches[rows])
+
+    def in_order(self, ids):
+        #table with the rows grouped by guide in the order of ids, each
+        #guide's rows in their current order; guides not in ids go last
+        rank = {_id: i for i, _id in enumerate(ids)}
+        guide_rank = np.array([rank.get(_id, len(rank)) for _id in self.guide_ids], dtype=np.int64)
+        if len(self) == 0:
+            return self
+        return self.take(np.argsort(guide_rank[self.guide], kind='stable'))
+
+    def guide_mask(self, ids):
+        #rows whose guide is one of ids
+        wanted = np.array([_id in ids for _id in self.guide_ids], dtype=bool)
+        return wanted[self.guide]
+
+    def save(self, fname):
+        with open(fname, 'wb') as fh:
+            np.savez(fh, guide_ids=np.array(self.guide_ids, dtype=str),
+                scaffolds=np.array(self.scaffolds, dtype=str), guide=self.guide,
+                forward=self.forward, scaffold=self.scaffold, pos=self.pos,
+                mismatches=self.mismatches)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            return cls(data['guide_ids'].tolist(), data['scaffolds'].tolist(),
+                data['guide'], data['forward'], data['scaffold'], data['pos'],
+                data['mismatches'])
+
+
+class HitTableBuilder:
+    #collects hits row by row into compact arrays
+    def __init__(self):
+        self.guide_codes = {}
+        self.scaffold_codes = {}
+        self.guide = array('i')
+        self.forward = array('b')
+        self.scaffold = array('i')
+        self.pos = array('q')
+        self.mismatches = array('b')
+
+    def add(self, _id, forward, scaffold, pos, mismatches):
+        self.guide.append(self.guide_codes.setdefault(_id, len(self.guide_codes)))
+        self.forward.append(forward)
+        self.scaffold.append(self.scaffold_codes.setdefault(scaffold, len(self.scaffold_codes)))
+        self.pos.append(pos)
+        self.mismatches.append(mismatches)
+
+    def table(self):
+        return HitTable(self.guide_codes, self.scaffold_codes,
+            np.frombuffer(self.guide, dtype=np.int32), np.frombuffer(self.forward, dtype=np.int8).astype(bool),
+            np.frombuffer(self.scaffold, dtype=np.int32), np.frombuffer(self.pos, dtype=np.int64),
+            np.frombuffer(self.mismatches, dtype=np.int8))
+
+
+def parse_hits(lines):
+    builder = HitTableBuilder()
+    for line in lines:
+        arr = line.rstrip('\n').split('\t')
+        if len(arr) > 5 and arr[5]:
+            mismatches = arr[5].count(',') + 1
+        else:
+            mismatches = 0
+        builder.add(arr[0], arr[1] == '+', arr[2], int(arr[3]), mismatches)
+    return builder.table()
+
+def concat_hits(tables):
+    #one table holding the rows of all tables, codes remapped
+    guide_codes = {}
+    scaffold_codes = {}
+    columns = {'guide': [], 'forward': [], 'scaffold': [], 'pos': [], 'mismatches': []}
+    for hits in tables:
+        guide_map = np.array([guide_codes.setdefault(g, len(guide_codes)) for g in hits.guide_ids], dtype=np.int32)
+        scaffold_map = np.array([scaffold_codes.setdefault(s, len(scaffold_codes)) for s in hits.scaffolds], dtype=np.int32)
+        columns['guide'].append(guide_map[hits.guide] if len(hits) else hits.guide)
+        columns['scaffold'].append(scaffold_map[hits.scaffold] if len(hits) else hits.scaffold)
+        columns['forward'].append(hits.forward)
+        columns['pos'].append(hits.pos)
+        columns['mismatches'].append(hits.mismatches)
+    if not tables:
+        return HitTableBuilder().table()
+    columns = {k: np.concatenate(v) for k, v in columns.items()}
+    return HitTable(guide_codes, scaffold_codes, columns['guide'], columns['forward'],
+        columns['scaffold'], columns['pos'], columns['mismatches'])
+
+def load_hits(bowtie_out, cache=False):
+    #bowtie_out is the bowtie output file, an iterable of its lines or an
+    #already loaded HitTable.
+    #With cache, a file is parsed once and later loads read <bowtie_out>.npz
+    if isinstance(bowtie_out, HitTable):
+        return bowtie_out
+    if isinstance(bowtie_out, str):
+        cache_file = f'{bowtie_out}.npz'
+        if cache and os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(bowtie_out):
+            return HitTable.load(cache_file)
+        with open(bowtie_out) as fh:
+            hits = parse_hits(fh)
+        if cache:
+            hits.save(cache_file)
+        return hits
+    return parse_hits(bowtie_out)
+
+def hit_chunks(bowtie_out, cache=False, size=None):
+    #tables of at most size hits of an iterable of hit lines, parsed as the
+    #lines arrive (e.g. from a running bowtie). A file or a table is loaded
+    #(load_hits) and given as one table
+    if isinstance(bowtie_out, (str, HitTable)):
+        yield load_hits(bowtie_out, cache)
+        return
+    lines = iter(bowtie_out)
+    while True:
+        chunk = list(islice(lines, size or HIT_CHUNK))
+        if not chunk:
+            return
+        yield parse_hits(chunk)
@@ -0,0 +1,74 @@
+import os
+import fcntl
+import shutil
+import hashlib
+import subprocess
+
+from .utils import dir_check
+
+
+# Bowtie indexes kept under <root>/<genome key>/genome_index, where the key
+# comes from the genome FASTA (path, size and mtime, or its full content with
+# digest=True). An index is reused when it already exists and passes
+# bowtie-inspect; builds hold a lock so concurrent jobs build only once.
+
+INDEX_PARTS = ['.1', '.2', '.rev.1', '.rev.2']
+#reference parts, not written by bowtie-build -r (--noref) and not needed
+#for unpaired alignment
+REF_PARTS = ['.3', '.4']
+
+
+def genome_key(genome_fa, digest=False):
+    h = hashlib.sha1()
+    if digest:
+        with open(genome_fa, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 24), b''):
+                h.update(block)
+    else:
+        st = os.stat(genome_fa)
+        h.update(f'{os.path.abspath(genome_fa)}:{st.st_size}:{st.st_mtime_ns}'.encode())
+    return h.hexdigest()[:16]
+
+def index_files(prefix):
+    #files of a small (.ebwt) or large (.ebwtl) index, None if incomplete
+    for ext in ('ebwt', 'ebwtl'):
+        files = [f'{prefix}{part}.{ext}' for part in INDEX_PARTS]
+        if all(os.path.isfile(f) for f in files):
+            return files + [f for f in (f'{prefix}{part}.{ext}' for part in REF_PARTS) if os.path.isfile(f)]
+    return None
+
+def valid_index(prefix):
+    if not index_files(prefix):
+        return False
+    res = subprocess.run(['bowtie-inspect', '-n', prefix], stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    return res.returncode == 0
+
+def ensure_index(genome_fa, root='bowtie_files', threads=1, digest=False):
+    #returns the prefix of a valid bowtie index of genome_fa, building it if needed
+    dir_check(root)
+    key = genome_key(genome_fa, digest)
+    outdir = os.path.join(root, key)
+    prefix = os.path.join(outdir, 'genome_index')
+    with open(os.path.join(root, f'{key}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if valid_index(prefix):
+            return prefix
+
+        tmpdir = f'{outdir}.tmp'
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        os.makedirs(tmpdir)
+        tmp_prefix = os.path.join(tmpdir, 'genome_index')
+        cmd = ['bowtie-build', '--threads', str(threads), '-r', '-q', '-f', genome_fa, tmp_prefix]
+        res = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if res.returncode != 0:
+            raise RuntimeError(f'bowtie-build failed on {genome_fa} (exit {res.returncode}):\n{res.stderr}')
+        if not valid_index(tmp_prefix):
+            raise RuntimeError(f'bowtie-build left an unusable index in {tmpdir}:\n{res.stderr}')
+
+        st = os.stat(genome_fa)
+        with open(os.path.join(tmpdir, 'genome.txt'), 'w') as fo:
+            fo.write(f'{os.path.abspath(genome_fa)}\t{st.st_size}\t{st.st_mtime_ns}\n')
+        shutil.rmtree(outdir, ignore_errors=True)
+        os.replace(tmpdir, outdir)
+    return prefix
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+
+
+class IntervalIndex:
+    #per scaffold sorted, merged intervals with closed ends [start, end],
+    #queried by binary search
+    def __init__(self, intervals=None):
+        self.starts = {}
+        self.ends = {}
+        for scaffold, regions in (intervals or {}).items():
+            self.add(scaffold, regions)
+
+    def add(self, scaffold, regions):
+        if len(regions) == 0:
+            return
+        regions = np.asarray(regions, dtype=np.int64).reshape(-1, 2)
+        regions = regions[np.argsort(regions[:, 0], kind='stable')]
+        starts = regions[:, 0]
+        ends = np.maximum.accumulate(regions[:, 1])
+        #a new block starts where an interval begins past the end of everything before it
+        new_block = np.ones(len(starts), dtype=bool)
+        new_block[1:] = starts[1:] > ends[:-1] + 1
+        first = np.flatnonzero(new_block)
+        last = np.append(first[1:], len(starts)) - 1
+        self.starts[scaffold] = starts[first]
+        self.ends[scaffold] = ends[last]
+
+    def __contains__(self, scaffold):
+        return scaffold in self.starts
+
+    def scaffolds(self):
+        return self.starts.keys()
+
+    def subset(self, scaffold):
+        #index holding only one scaffold, e.g. to ship to a worker process
+        index = IntervalIndex()
+        if scaffold in self.starts:
+            index.starts[scaffold] = self.starts[scaffold]
+            index.ends[scaffold] = self.ends[scaffold]
+        return index
+
+    def save(self, fname):
+        #written to a temporary file first, an interrupted run leaves no
+        #truncated cache behind
+        scaffolds = list(self.starts)
+        tmp = f'{fname}.tmp'
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, scaffolds=np.array(scaffolds, dtype=str),
+                sizes=np.array([len(self.starts[s]) for s in scaffolds], dtype=np.int64),
+                starts=np.concatenate([self.starts[s] for s in scaffolds] or [np.zeros(0, dtype=np.int64)]),
+                ends=np.concatenate([self.ends[s] for s in scaffolds] or [np.zeros(0, dtype=np.int64)]))
+        os.replace(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        index = cls()
+        with np.load(fname) as data:
+            bounds = np.concatenate([[0], np.cumsum(data['sizes'])])
+            starts = data['starts']
+            ends = data['ends']
+            for i, scaffold in enumerate(data['scaffolds'].tolist()):
+                index.starts[scaffold] = starts[bounds[i]:bounds[i+1]]
+                index.ends[scaffold] = ends[bounds[i]:bounds[i+1]]
+        return index
+
+    def contains(self, scaffold, pos):
+        if scaffold not in self.starts:
+            return False
+        k = np.searchsorted(self.starts[scaffold], pos, side='right') - 1
+        return bool(k >= 0 and pos <= self.ends[scaffold][k])
+
+    def contains_many(self, scaffold, positions):
+        #vectorized membership test, returns a boolean array
+        positions = np.asarray(positions, dtype=np.int64)
+        if scaffold not in self.starts:
+            return np.zeros(len(positions), dtype=bool)
+        starts = self.starts[scaffold]
+        ends = self.ends[scaffold]
+        k = np.searchsorted(starts, positions, side='right') - 1
+        inside = k >= 0
+        inside[inside] = positions[inside] <= ends[k[inside]]
+        return inside
@@ -0,0 +1,26 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+ambiguous_alph = {"N":["A","C","G","T"], "V":["A","C","G"], "H":["A","C","T"], "D":["A","G","T"],
+    "B":["C","G","T"], "M":["A","C"], "K":["G","T"], "W":["A","T"], "S":["C","G"], "Y":["C","T"],
+    "R":["A","G"], "A": ["A"], "C": ["C"], "G": ["G"], "T": ["T"]}
+
+complement = str.maketrans('ACTGNYRWSKMDHVBX-', 'TGACNRYWSMKHDBVX-')
+
+BASE_BITS = np.zeros(256, dtype=np.uint8) #byte -> base bit, 0 for N and others
+BASE_CODES = np.full(256, 4, dtype=np.uint8) #byte -> 2-bit code, 4 for N and others
+for _code, _base in enumerate('ACGT'):
+    BASE_BITS[ord(_base)] = 1 << _code
+    BASE_CODES[ord(_base)] = _code
+
+
+def revcomp(sequence):
+    #returns reverse complement of sequence
+    return sequence.translate(complement)[::-1]
+
+@lru_cache(maxsize=None)
+def pam_bitmask(PAM):
+    #per position bitmask of the accepted bases, A=1 C=2 G=4 T=8
+    return np.array([sum(BASE_BITS[ord(b)] for b in ambiguous_alph[base]) for base in PAM], dtype=np.uint8)
@@ -0,0 +1,77 @@
+import json
+import time
+import cProfile
+import resource
+from contextlib import contextmanager
+
+
+# Wall time, CPU time, memory and item counts per pipeline stage. Stages
+# can nest; a nested stage is named parent/child and its time is also part
+# of the parent's.
+
+
+def rss_mb(field='VmHWM'):
+    #peak (VmHWM) or current (VmRSS) resident memory of this process image;
+    #ru_maxrss is the fallback, it also counts a parent's peak across fork
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def children_cpu():
+    #CPU seconds of finished child processes (pool workers, bowtie)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StageRecorder:
+    def __init__(self, profile=None, profile_out=None):
+        self.profile = profile #name of the stage to run under cProfile
+        self.profile_out = profile_out
+        self.stages = []
+        self.counts = {}
+        self.stack = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        #yields the stage record, callers add items_in, items_out or other
+        #counts to it
+        self.stack.append(name)
+        record = {'stage': '/'.join(self.stack)}
+        record.update(counts)
+        profiler = cProfile.Profile() if record['stage'] == self.profile else None
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        child_cpu = children_cpu()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.profile_out or f'{record["stage"].replace("/", ".")}.prof')
+            record['wall_s'] = round(time.perf_counter() - wall, 4)
+            record['cpu_s'] = round(time.process_time() - cpu, 4)
+            record['children_cpu_s'] = round(children_cpu() - child_cpu, 4)
+            record['rss_mb'] = round(rss_mb('VmRSS'), 1)
+            record['peak_rss_mb'] = round(rss_mb(), 1)
+            self.stages.append(record)
+            self.stack.pop()
+
+    def count(self, **counts):
+        #run-wide counters, e.g. guides discarded per reason
+        self.counts.update(counts)
+
+    def report(self):
+        return {'stages': self.stages, 'counts': self.counts,
+            'wall_s': round(time.perf_counter() - self.start, 4), 'peak_rss_mb': round(rss_mb(), 1)}
+
+    def save(self, fname):
+        with open(fname, 'w') as fo:
+            json.dump(self.report(), fo, indent=2)
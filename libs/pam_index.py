@@ -0,0 +1,240 @@
+import os
+import fcntl
+import shutil
+from itertools import combinations, product
+
+import numpy as np
+
+from .iupac import BASE_BITS, BASE_CODES, revcomp, pam_bitmask
+
+
+# In-process off-target search. Every PAM-flanked protospacer of the genome
+# is stored 2-bit packed (in guide orientation) together with its scaffold,
+# bowtie-style position and strand. A guide with up to d mismatches against a
+# site has at most d//2 mismatches in one of its two halves (pigeonhole), so
+# each half is indexed as a sorted seed key and queried with all of its
+# neighbours within d//2 substitutions; the candidates are then verified by
+# Hamming distance on the packed codes.
+
+FIELDS = ['code', 'scaffold', 'pos', 'forward', 'key0', 'order0', 'key1', 'order1']
+#site columns, written scaffold by scaffold while the genome is scanned
+SITE_DTYPES = {'code': np.uint64, 'scaffold': np.uint32, 'pos': np.uint32, 'forward': bool}
+MAX_GUIDE_LENGTH = 32 #2-bit codes of a whole spacer fit in a uint64
+
+
+def index_dir(prefix, PAM, guide_length):
+    return f'{prefix}.{PAM}.{guide_length}.pamidx'
+
+def encode(seq):
+    #2-bit code of an ACGT string, None if it has any other base
+    codes = BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    if (codes > 3).any():
+        return None
+    code = 0
+    for c in codes.tolist():
+        code = (code << 2) | c
+    return code
+
+def decode(code, k):
+    return ''.join('ACGT'[(code >> 2*(k-1-i)) & 3] for i in range(k))
+
+def popcount(x):
+    #number of set bits of each uint64
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def hamming(codes, code):
+    #mismatching bases between packed k-mers
+    x = codes ^ np.uint64(code)
+    return popcount((x | (x >> np.uint64(1))) & np.uint64(0x5555555555555555))
+
+def neighbours(key, k, max_mismatches):
+    #every k-mer key within max_mismatches substitutions of key
+    keys = [key]
+    for n in range(1, max_mismatches + 1):
+        for sites in combinations(range(k), n):
+            for subs in product(range(1, 4), repeat=n):
+                variant = key
+                for site, sub in zip(sites, subs):
+                    shift = 2 * (k - 1 - site)
+                    variant ^= sub << shift
+                keys.append(variant)
+    return np.array(keys, dtype=np.uint64)
+
+def scaffold_sites(seq, PAM, guide_length):
+    #PAM-flanked protospacers of one scaffold (uint8 array of bases)
+    PAM_length = len(PAM)
+    n = len(seq) - guide_length - PAM_length + 1
+    if n <= 0:
+        return [np.zeros(0, dtype=dt) for dt in (np.uint64, np.uint32, bool)]
+    bits = BASE_BITS[seq]
+    codes = BASE_CODES[seq]
+
+    #+ strand: protospacer at p, PAM right after it
+    fwd = np.ones(n, dtype=bool)
+    for j, mask in enumerate(pam_bitmask(PAM)):
+        fwd &= (bits[guide_length+j:guide_length+j+n] & mask) != 0
+    #- strand: reverse complement PAM right before the protospacer at q
+    rev = np.ones(n, dtype=bool)
+    for j, mask in enumerate(pam_bitmask(revcomp(PAM))):
+        rev &= (bits[j:j+n] & mask) != 0
+    fwd_pos = np.flatnonzero(fwd)
+    rev_pos = np.flatnonzero(rev) + PAM_length
+
+    kmers = []
+    valids = []
+    for starts, forward in ((fwd_pos, True), (rev_pos, False)):
+        kmer = np.zeros(len(starts), dtype=np.uint64)
+        valid = np.ones(len(starts), dtype=bool)
+        for i in range(guide_length):
+            c = codes[starts + i]
+            valid &= c < 4
+            c = c.astype(np.uint64) & np.uint64(3)
+            if forward:
+                kmer = (kmer << np.uint64(2)) | c
+            else:
+                kmer |= (np.uint64(3) - c) << np.uint64(2*i)
+        kmers.append(kmer[valid])
+        valids.append(starts[valid])
+    forward = np.concatenate([np.ones(len(valids[0]), dtype=bool), np.zeros(len(valids[1]), dtype=bool)])
+    return np.concatenate(kmers), np.concatenate(valids).astype(np.uint32), forward
+
+
+def raw_to_npy(raw, npy, dtype, n):
+    #.npy file of n values of dtype from their raw bytes, removing raw
+    with open(npy, 'wb') as fo, open(raw, 'rb') as fh:
+        np.lib.format.write_array_header_1_0(fo, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False, 'shape': (n,)})
+        shutil.copyfileobj(fh, fo, 1 << 24)
+    os.remove(raw)
+
+
+class PamIndex:
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'meta.tsv')) as fh:
+            PAM, guide_length = fh.readline().split()
+            self.PAM = PAM
+            self.guide_length = int(guide_length)
+            self.scaffolds = [line.rstrip('\n') for line in fh]
+        for field in FIELDS:
+            setattr(self, field, np.load(os.path.join(dirname, f'{field}.npy'), mmap_mode='r'))
+        self.half = self.guide_length // 2
+        self.half_mask = (1 << 2*(self.guide_length - self.half)) - 1
+
+    @classmethod
+    def build(cls, genome_seqs, PAM, guide_length, dirname):
+        #columns are streamed to disk per scaffold; the seed keys and their
+        #sort orders are uint32 and sorted one half at a time, so the build
+        #holds one scaffold's sites and 8 bytes per genome site at most
+        if guide_length > MAX_GUIDE_LENGTH:
+            raise ValueError(f'The built-in index holds spacers of up to {MAX_GUIDE_LENGTH} bp, not {guide_length}')
+        scaffolds = list(genome_seqs)
+        tmp = f'{dirname}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        n = 0
+        raw = {field: open(os.path.join(tmp, f'{field}.raw'), 'wb') for field in SITE_DTYPES}
+        for i, scaffold in enumerate(scaffolds):
+            code, pos, forward = scaffold_sites(genome_seqs.array(scaffold), PAM, guide_length)
+            raw['code'].write(code.tobytes())
+            raw['pos'].write(pos.tobytes())
+            raw['forward'].write(forward.tobytes())
+            raw['scaffold'].write(np.full(len(code), i, dtype=np.uint32).tobytes())
+            n += len(code)
+        for field, fh in raw.items():
+            fh.close()
+            raw_to_npy(os.path.join(tmp, f'{field}.raw'), os.path.join(tmp, f'{field}.npy'), SITE_DTYPES[field], n)
+        if n >= 1 << 32:
+            raise ValueError(f'{n} PAM sites, the built-in index holds fewer than 2^32')
+
+        code = np.load(os.path.join(tmp, 'code.npy'), mmap_mode='r')
+        half = guide_length // 2
+        shift = 2*(guide_length - half)
+        for h in ('0', '1'):
+            #key and site packed into one uint64, sorted in place: ties keep
+            #the site order, as a stable argsort of the keys would
+            packed = np.empty(n, dtype=np.uint64)
+            for a in range(0, n, 1 << 24):
+                c = code[a:a+(1 << 24)]
+                key = c >> np.uint64(shift) if h == '0' else c & np.uint64((1 << shift) - 1)
+                packed[a:a+len(c)] = (key << np.uint64(32)) | np.arange(a, a+len(c), dtype=np.uint64)
+            packed.sort()
+            keys = np.lib.format.open_memmap(os.path.join(tmp, f'key{h}.npy'), mode='w+', dtype=np.uint32, shape=(n,))
+            order = np.lib.format.open_memmap(os.path.join(tmp, f'order{h}.npy'), mode='w+', dtype=np.uint32, shape=(n,))
+            for a in range(0, n, 1 << 24):
+                keys[a:a+(1 << 24)] = packed[a:a+(1 << 24)] >> np.uint64(32)
+                order[a:a+(1 << 24)] = packed[a:a+(1 << 24)] & np.uint64(0xffffffff)
+            keys.flush()
+            order.flush()
+            del packed, keys, order
+        del code
+
+        with open(os.path.join(tmp, 'meta.tsv'), 'w') as fo:
+            fo.write(f'{PAM}\t{guide_length}\n')
+            for scaffold in scaffolds:
+                fo.write(f'{scaffold}\n')
+        shutil.rmtree(dirname, ignore_errors=True)
+        os.replace(tmp, dirname)
+        return cls(dirname)
+
+    def __len__(self):
+        return len(self.code)
+
+    def candidates(self, code, mismatches):
+        found = []
+        max_seed = mismatches // 2
+        halves = ((code >> 2*(self.guide_length - self.half), self.half, self.key0, self.order0),
+            (code & self.half_mask, self.guide_length - self.half, self.key1, self.order1))
+        for key, k, keys, order in halves:
+            variants = neighbours(key, k, max_seed).astype(keys.dtype)
+            lo = np.searchsorted(keys, variants, side='left')
+            hi = np.searchsorted(keys, variants, side='right')
+            for a, b in zip(lo.tolist(), hi.tolist()):
+                if b > a:
+                    found.append(order[a:b])
+        if not found:
+            return np.zeros(0, dtype=np.uint32)
+        return np.unique(np.concatenate(found))
+
+    def search(self, guides, mismatches=3):
+        #yields bowtie-like hit lines (name, strand, scaffold, position,
+        #sequence, mismatches) for the PAM-flanked sites of each guide.
+        #Mismatches are reported in guide orientation as offset:site>guide
+        L = self.guide_length
+        for _id, guide in guides.items():
+            guide = str(guide)
+            code = encode(guide) if len(guide) == L else None
+            if code is None:
+                print(f'{_id}: only {L} bp ACGT spacers can be searched, skipped.')
+                continue
+            sites = self.candidates(code, mismatches)
+            if len(sites) == 0:
+                continue
+            site_codes = self.code[sites]
+            close = hamming(site_codes, code) <= mismatches
+            for site, site_code in zip(sites[close].tolist(), site_codes[close].tolist()):
+                site_seq = decode(site_code, L)
+                mm = ','.join(f'{i}:{s}>{g}' for i, (s, g) in enumerate(zip(site_seq, guide)) if s != g)
+                scaffold = self.scaffolds[self.scaffold[site]]
+                if self.forward[site]:
+                    yield f'{_id}\t+\t{scaffold}\t{self.pos[site]}\t{guide}\t{mm}\n'
+                else:
+                    yield f'{_id}\t-\t{scaffold}\t{self.pos[site]}\t{revcomp(guide)}\t{mm}\n'
+
+def open_pam_index(genome_seqs, PAM, guide_length):
+    #opens the index stored next to the genome store, (re)building it when
+    #it is missing or older than the store. Builds hold a lock, concurrent
+    #jobs build only once
+    dirname = index_dir(genome_seqs.prefix, PAM, guide_length)
+    meta = os.path.join(dirname, 'meta.tsv')
+    def current():
+        return os.path.isfile(meta) and os.path.getmtime(meta) >= os.path.getmtime(f'{genome_seqs.prefix}.seq')
+    if not current():
+        with open(f'{dirname}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not current():
+                return PamIndex.build(genome_seqs, PAM, guide_length, dirname)
+    return PamIndex(dirname)
@@ -1,9 +1,39 @@
 import os
 import re
 import sys
+import json
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 
 import pysam
 
+COUNT_MODES = ('all', 'mapped', 'primary')
+
+
+def totals_file(bam):
+    return f'{bam}.totals.json'
+
+def load_totals(bam):
+    #cached totals of bam, empty if the BAM changed since they were written
+    st = os.stat(bam)
+    try:
+        with open(totals_file(bam)) as fh:
+            totals = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    if totals.pop('bam', None) != [os.path.abspath(bam), st.st_size, st.st_mtime_ns]:
+        return {}
+    return totals
+
+def save_totals(bam, totals):
+    st = os.stat(bam)
+    record = dict(totals, bam=[os.path.abspath(bam), st.st_size, st.st_mtime_ns])
+    try:
+        with open(totals_file(bam), 'w') as fo:
+            json.dump(record, fo)
+    except OSError:
+        pass #read-only BAM directory, totals are recomputed next time
+
 def process_CIGAR(pos, cigar):
     block_lengths  = [] 
     soft_clippings = []
@@ -28,11 +58,32 @@ class BamParser:
         self.bam = bam
         self.bamfile = pysam.AlignmentFile(bam, 'rb')
 
-    def total_reads(self):
-        pattern = re.compile(r'(\d+).*in total')
-        res = pysam.flagstat(self.bam)
-        m = pattern.search(res)
-        total_reads = int(m.group(1))
+    def total_reads(self, mode='all'):
+        #all records, mapped records or primary alignments (no secondary or
+        #supplementary, needs a full pass). all and mapped are read from the
+        #index when there is one, else from flagstat. Totals are kept in a
+        #sidecar file next to the BAM
+        if mode not in COUNT_MODES:
+            raise ValueError(f'Unknown count mode {mode}, choose from {", ".join(COUNT_MODES)}')
+        totals = load_totals(self.bam)
+        if mode in totals:
+            return totals[mode]
+
+        if mode == 'primary':
+            total_reads = int(pysam.view('-c', '-F', '0x900', self.bam))
+        elif self.bamfile.has_index():
+            total_reads = self.bamfile.mapped
+            if mode == 'all':
+                total_reads += self.bamfile.unmapped
+        else:
+            #QC-passed plus QC-failed, as the index counts them
+            pattern = re.compile(r'(\d+) \+ (\d+) in total' if mode == 'all' else r'(\d+) \+ (\d+) mapped \(')
+            res = pysam.flagstat(self.bam)
+            m = pattern.search(res)
+            total_reads = int(m.group(1)) + int(m.group(2))
+
+        totals[mode] = total_reads
+        save_totals(self.bam, totals)
         return total_reads
         
     def bin_count(self, region):
@@ -48,6 +99,40 @@ class BamParser:
                 n += 1
         return n
 
+    def region_count(self, bins):
+        #counts of many bins at once, same as bin_count on each of them.
+        #Overlapping bins are grouped into clusters, each cluster is fetched
+        #once and every read's CIGAR is processed once; a read is only
+        #tested (with valid_read) against the bins its blocks overlap
+        counts = [0] * len(bins)
+        by_chrom = defaultdict(list)
+        for i, (chrom, start, end) in enumerate(bins):
+            by_chrom[chrom].append((start, end, i))
+
+        for chrom, chrom_bins in by_chrom.items():
+            chrom_bins.sort()
+            for cluster in bin_clusters(chrom_bins):
+                starts = [start for start, _, _ in cluster]
+                max_len = max(end - start for start, end, _ in cluster)
+                c_start = cluster[0][0]
+                c_end = max(end for _, end, _ in cluster)
+                for read in self.bamfile.fetch(chrom, c_start, c_end):
+                    r_blocks, soft_clippings = process_CIGAR(read.pos, read.cigar)
+
+                    if any(SC > self.maxSoftClip for SC in soft_clippings):
+                        continue
+
+                    candidates = set()
+                    for bs, be in r_blocks:
+                        lo = bisect_right(starts, bs - max_len)
+                        hi = bisect_left(starts, be)
+                        candidates.update(range(lo, hi))
+                    for k in candidates:
+                        start, end, i = cluster[k]
+                        if self.valid_read((chrom, start, end), r_blocks):
+                            counts[i] += 1
+        return counts
+
     def valid_read(self, region, r_blocks):
         _, start, end = region
         bin_len = end - start
@@ -69,3 +154,15 @@ class BamParser:
     def close(self):
         self.bamfile.close()
 
+def bin_clusters(chrom_bins):
+    #groups (start, end, i) bins sorted by start into runs of overlapping bins
+    cluster = [chrom_bins[0]]
+    c_end = chrom_bins[0][1]
+    for b in chrom_bins[1:]:
+        if b[0] >= c_end:
+            yield cluster
+            cluster = []
+        cluster.append(b)
+        c_end = max(c_end, b[1])
+    yield cluster
+
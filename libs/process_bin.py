@@ -44,6 +44,30 @@ class BinBuilder:
 
         return bins
 
+    def chunks(self, size=64):
+        #bins cut into runs of at most size bins, never spanning two
+        #intervals of the bed, in the (chrom, start) order of their first bin
+        chunks = []
+        try:
+            fh = open(self.bed)
+        except Exception as err:
+            print(f"Open file error: {err}")
+            raise
+
+        regions = []
+        for line in fh:
+            if line.startswith('@'):
+                continue
+            arr = line.split()
+            regions.append((arr[0], int(arr[1]), int(arr[2])))
+        fh.close()
+        for region in regions:
+            bins = self.splitter(region)
+            for pos in range(0, len(bins), size):
+                chunks.append(bins[pos: pos+size])
+        chunks.sort(key=lambda chunk: chunk[0][:2])
+        return chunks
+
     def interval_batch(self, p):
         intervals = []
         allbins = self.interval()
@@ -61,7 +85,7 @@ class BinBuilder:
         return intervals
 
 
-def random_bins(fbed, bin_len=100):
+def random_bins(fbed, bin_len=100, rng=random):
     intervals = defaultdict(list)
     steps = bin_len * 0.4
     with open(fbed) as fh:
@@ -78,7 +102,7 @@ def random_bins(fbed, bin_len=100):
             else:
                 segs = round(rlen/steps)
                 for i in range(segs):
-                    pos = random.randint(start, end)
+                    pos = rng.randint(start, end)
                     pos_end = min(end, pos+bin_len)
                     if pos_end - pos < 30:
                         continue
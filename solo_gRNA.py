@@ -3,21 +3,34 @@ import os
 import sys
 import csv
 import random
+import socket
 import argparse
+import tempfile
 import subprocess
+import socketserver
+from io import StringIO
 from uuid import uuid4
-from bisect import bisect_right, insort_left
-from collections import defaultdict, Counter
+from bisect import bisect_right
+from collections import defaultdict
+from array import array
+from multiprocessing import Pool
 
+import numpy as np
 import primer3 #primer3-py package
 from Bio import Seq
 from Bio import SeqIO
-from itertools import product
+from functools import lru_cache
 
+from libs.genome_store import open_genome, GenomeStore
+from libs.intervals import IntervalIndex
+from libs.hit_table import HitTable, load_hits, concat_hits, hit_chunks
+from libs.guide_cache import GuideCache, fingerprint
+from libs.iupac import ambiguous_alph, revcomp, BASE_BITS, pam_bitmask
+from libs.pam_index import open_pam_index, MAX_GUIDE_LENGTH
+from libs.index_manager import ensure_index
+from libs.metrics import StageRecorder
+from libs.utils import dir_check
 
-ambiguous_alph = {"N":["A","C","G","T"], "V":["A","C","G"], "H":["A","C","T"], "D":["A","G","T"],
-    "B":["C","G","T"], "M":["A","C"], "K":["G","T"], "W":["A","T"], "S":["C","G"], "Y":["C","T"],
-    "R":["A","G"], "A": ["A"], "C": ["C"], "G": ["G"], "T": ["T"]}
 
 def reverse_dict(dic):
     return {v: k for k, v in dic.items()}
@@ -27,39 +40,37 @@ def check_dir(dirname):
         return None
     os.mkdir(dirname)
 
-def remove_ambiguous(sequence):
-    #returns a list of all possible sequences
-    #given the ambiguous sequence input (e.g. with N,V, etc. bases)
-    return ["".join(i) for i in product(*[ ambiguous_alph[j] for j in sequence ]) ]
+def pam_regex(PAM):
+    #character classes matching an ambiguous (IUPAC) PAM, e.g. NGG -> [ACGT][G][G]
+    return ''.join(f'[{"".join(ambiguous_alph[base])}]' for base in PAM)
 
-def prepare_for_bowtie(guides):
-    input_fa = 'input.fa'
+@lru_cache(maxsize=None)
+def pam_scanner(PAM):
+    #one lookahead pattern finding either strand of the PAM at every
+    #(overlapping) position, plus one pattern per strand to tell them apart
+    bot = pam_regex(PAM)
+    top = pam_regex(revcomp(PAM))
+    return re.compile(f'(?=(?:{bot}|{top}))'), re.compile(bot), re.compile(top)
+
+def prepare_for_bowtie(guides, input_fa='input.fa'):
     with open(input_fa, 'w+') as fh: #input file for bowtie
         for _id, seq in guides.items():
             fh.write(f'>{_id}\n{seq}\n')
     return input_fa
 
-def revcomp(sequence):
-    #returns reverse complement of sequence
-    complement = {'A':'T', 'C':'G', 'T':'A', 'G':'C', 'N':'N','Y':'R',
-    'R':'Y', 'W':'W', 'S':'S', 'K':'M', 'M':'K', 'D':'H', 'H':'D',
-    'V':'B', 'B':'V', 'X':'X', '-':'-'}
-    string_list = list(sequence)
-    string_list.reverse()
-    revcompl = ''
-    for base in string_list:
-        revcompl += complement[base]
-    return revcompl
-
-def find_all(string, substr):
-    #makes a list with the indexes of all occurrencies of substr in string
-    listindex=[]
-    start = 0
-    i = string.find(substr, start)
-    while i >= 0:
-        listindex.append(i)
-        i = string.find(substr, i + 1)
-    return listindex
+def find_pams(sequence, PAM):
+    #indexes of the PAM in sequence (bottom strand guides) and of its
+    #reverse complement (top strand guides), in a single scan
+    both, bot, top = pam_scanner(PAM)
+    PAMs_bot = []
+    PAMs_top = []
+    for m in both.finditer(sequence):
+        i = m.start()
+        if bot.match(sequence, i):
+            PAMs_bot.append(i)
+        if top.match(sequence, i):
+            PAMs_top.append(i)
+    return PAMs_bot, PAMs_top
 
 def GC_count(string):
     #returns %GC of string
@@ -88,48 +99,110 @@ def retrieve_guide(PAM,strand, sequence, guide_length=20, PAM_length=3):
             guide = None
     return guide
 
-def offtarget(list_of_PAMs, genome_seqs, positions, exon_pos, scaffold, start, end, index):
-    #checks if the offtarget is followed by a PAM
-    #and if it's outside a rRNA gene.
-    #If so, removes the spacer from guides_dict and returns 1.
-    if any (genome_seqs[scaffold][start:end] == PAM for PAM in list_of_PAMs):
-        if scaffold in positions:
-            if not any(index in range(i,j+1) for [i, j] in positions[scaffold]) and any(index in range(i,j+1) for [i, j] in exon_pos[scaffold]):
-                #if the index is not in at least one rRNA gene:
-                return True
-    return False
-
-def primer_heterodimer(oligo, primer_revcomp):
+def primer_heterodimer(oligo, primer_revcomp, het_tm=40, end_tm=30, verbose=False):
     #checks for unwanted internal binding of the fill-in primer to oligo.
     #cutoffs are predicted melting temperature of the annealing >40 °C and 
     #of the 3' portion of 30 °C
+    #returns the verdict and, if verbose, a report for discarded oligos
     res_end = primer3.bindings.calcEndStability(primer_revcomp,oligo)
-    res_het = primer3.bindings.calcHeterodimer(primer_revcomp,oligo,output_structure=True)
-    if res_het.tm > 40 or res_end.tm > 30:
-        print("\nThe end-filling primer has high predicted internal binding to the", "oligo\nThis oligo is discarded.")
-        print("Heterodimer formation:")
-        print(res_het)
-        print("End Stability:")
-        print(res_end)
-        print("Predicted binding:")
-        print(res_het.ascii_structure)
-        return True
-    return None
-
-def build_index(genome_fa):
-    check_dir('bowtie_files')
-    bowtie_idx = 'bowtie_files/genome_index'
-    cmd = (f"bowtie-build -r -q -f {genome_fa} bowtie_files/genome_index"),
-    subprocess.call(cmd, shell=True, stderr=subprocess.DEVNULL)
-    return bowtie_idx
-
-def run_bowtie(input_fa, bowtie_idx):
+    res_het = primer3.bindings.calcHeterodimer(primer_revcomp,oligo,output_structure=verbose)
+    if res_het.tm > het_tm or res_end.tm > end_tm:
+        report = None
+        if verbose:
+            report = "\n".join(["\nThe end-filling primer has high predicted internal binding to the oligo",
+                "This oligo is discarded.", "Heterodimer formation:", str(res_het), "End Stability:",
+                str(res_end), "Predicted binding:", str(res_het.ascii_structure)])
+        return True, report
+    return False, None
+
+def heterodimer_chunk(oligos, primer_revcomp, het_tm, end_tm, verbose):
+    #pool worker: verdicts and reports for a batch of oligos
+    return [primer_heterodimer(oligo, primer_revcomp, het_tm, end_tm, verbose) for oligo in oligos]
+
+def build_index(genome_fa, threads=1, digest=False, root='bowtie_files'):
+    #reuses or builds the bowtie index of genome_fa under root
+    return ensure_index(genome_fa, root, threads, digest)
+
+def bowtie_cmd(input_fa, bowtie_idx, threads=1):
+    #matches with up to 3 mismatches, reporting all of them. With several
+    #threads --reorder keeps the input order, the density collapse depends on it
+    cmd = ['bowtie', '-v', '3', '-a', '-p', str(threads)]
+    if threads > 1:
+        cmd.append('--reorder')
+    return cmd + ['--suppress', '6,7', '-f', bowtie_idx, input_fa]
+
+def run_bowtie(input_fa, bowtie_idx, threads=1):
+    bowtie_out = 'bowtie.csv'
+    with open(bowtie_out, 'w') as fo:
+        subprocess.run(bowtie_cmd(input_fa, bowtie_idx, threads), stdout=fo, stderr=subprocess.DEVNULL, check=True)
+    return bowtie_out
+
+def stream_bowtie(input_fa, bowtie_idx, threads=1, tee=None):
+    #starts bowtie right away and returns an iterator over its hits as they
+    #are reported, optionally copying them to tee
+    proc = subprocess.Popen(bowtie_cmd(input_fa, bowtie_idx, threads),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1<<16)
+    return _bowtie_lines(proc, tee)
+
+def _bowtie_lines(proc, tee):
+    fo = open(tee, 'w') if tee else None
+    try:
+        for line in proc.stdout:
+            if fo:
+                fo.write(line)
+            yield line
+    finally:
+        if fo:
+            fo.close()
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+def run_builtin(guides, pam_index):
+    #same records as run_bowtie, from the in-process PAM site index
     bowtie_out = 'bowtie.csv'
-    cmd = (f"bowtie -v 3 -a {bowtie_idx} --suppress 6,7 \
-        -f {input_fa} > {bowtie_out}") #matches with up to 3 mismatches
-    subprocess.call(cmd, shell=True, stderr=subprocess.DEVNULL)
+    with open(bowtie_out, 'w') as fo:
+        for line in pam_index.search(guides):
+            fo.write(line)
     return bowtie_out
 
+def write_hits(fname, hits, guides, genome_seqs):
+    #hit table as bowtie lines, mismatches written in guide orientation as
+    #offset:site>guide (as the built-in engine writes them) from the genome
+    with open(fname, 'w') as fo:
+        for g, forward, c, pos in zip(hits.guide.tolist(), hits.forward.tolist(), hits.scaffold.tolist(),
+                hits.pos.tolist()):
+            _id = hits.guide_ids[g]
+            guide = str(guides[_id])
+            scaffold = hits.scaffolds[c]
+            site = genome_seqs[scaffold][pos:pos+len(guide)]
+            if not forward:
+                site = revcomp(site)
+            mm = ','.join(f'{i}:{a}>{b}' for i, (a, b) in enumerate(zip(site, guide)) if a != b)
+            fo.write(f'{_id}\t{"+" if forward else "-"}\t{scaffold}\t{pos}\t{guide if forward else revcomp(guide)}\t{mm}\n')
+
+def search_offtargets(guides, engine, genome_seqs, bowtie_idx, PAM, guide_length=20, threads=1, stream=False, tee=None):
+    #runs the selected off-target search on guides, returns the hits output
+    if engine == 'builtin':
+        return run_builtin(guides, open_pam_index(genome_seqs, PAM, guide_length))
+    input_fa = prepare_for_bowtie(guides)
+    if stream:
+        return stream_bowtie(input_fa, bowtie_idx, threads, tee=tee)
+    return run_bowtie(input_fa, bowtie_idx, threads)
+
+def search_batch(guides, jobs, engine, genome_seqs, bowtie_idx, threads=1):
+    #one off-target search for the guides of all batch jobs. bowtie takes
+    #every spacer length at once, the built-in index is per PAM and length
+    if engine == 'bowtie':
+        return load_hits(run_bowtie(prepare_for_bowtie(guides), bowtie_idx, threads))
+    tables = []
+    for PAM, guide_length in sorted({(job['pam'], job['length']) for job in jobs}):
+        group = {_id: seq for job in jobs if (job['pam'], job['length']) == (PAM, guide_length)
+            for _id, seq in job['guides'].items() if _id in guides}
+        pam_index = open_pam_index(genome_seqs, PAM, guide_length)
+        tables.append(load_hits(pam_index.search(group)))
+    return concat_hits(tables)
+
 def gen_seq_id(rRNA):
     num = random.randint(1000, 3000)
     string = str(uuid4())
@@ -144,27 +217,17 @@ def read_guids(gfa):
             guides[record.id] = record.seq
     return guides
 
-def enumerate_rrna_regions(genome_fa, rna_bed):
-    rrna_pattern = re.compile(r'transcript_biotype "rRNA"')
-    regex_rrna = re.compile('(\d*S) ribosomal')
-    genome_fh = open(genome_fa)
-    rna_fh = open(rna_bed)
+def enumerate_rrna_regions(genome_fa, rna_bed, genome_store=None):
+    genome_seqs = open_genome(genome_fa, genome_store) #memory mapped, scaffold:sequence
+    rRNA_genes, positions = read_rrna_regions(genome_seqs, rna_bed)
+    return rRNA_genes, positions, genome_seqs
 
-    genome = SeqIO.parse(genome_fh, 'fasta')
-    genome_seqs = {}
+def read_rrna_regions(genome_seqs, rna_bed):
+    rna_fh = open(rna_bed)
     rRNA_genes = {"5S":[], "LSU":[], "SSU":[], "MT": []}
     positions = {} #dictionary of start end end positions of the rRNA genes
                    #scaffold:[[start1,end1],[start2,end2]]
 
-    for record in genome:
-        if "genome" in record.description: #if it's the main chromosome
-            genome_id = re.findall('[^ ]+', record.description)[0]
-            genome_seqs[genome_id] = str(record.seq).upper()
-        else:
-            plasmid_id = re.findall('[^ ]+', record.description)[0]
-            genome_seqs["{0}".format(plasmid_id)] = str(record.seq).upper()
-    genome_fh.close()
-
     rna_fh.readline()
     for line in rna_fh:
         if line[0] == "#":
@@ -183,41 +246,71 @@ def enumerate_rrna_regions(genome_fa, rna_bed):
         else:
             seq = str(genome_seqs[scaffold][start:end])
         rRNA_genes[ID].append(seq)
-    return rRNA_genes, positions, genome_seqs
+    rna_fh.close()
+    return rRNA_genes, positions
+
+def read_manifest(manifest):
+    #batch jobs, one per row of a tab-separated file with a header naming
+    #bed and prefix, and optionally pam, length, minGC and maxGC
+    jobs = []
+    with open(manifest) as fh:
+        for row in csv.DictReader((line for line in fh if not line.startswith('#')), delimiter='\t'):
+            jobs.append({'bed': row['bed'], 'prefix': row['prefix'],
+                'pam': (row.get('pam') or 'NGG').upper(), 'length': int(row.get('length') or 20),
+                'minGC': int(row.get('minGC') or 30), 'maxGC': int(row.get('maxGC') or 70)})
+    return jobs
+
+def exon_positions(gtf, feature='exon', cache_dir='gtf_cache'):
+    #merged intervals of one GTF feature type ('all' keeps every line) as an
+    #IntervalIndex, cached in cache_dir keyed on the GTF path, size and mtime
+    cache_file = None
+    if cache_dir:
+        dir_check(cache_dir)
+        cache_file = os.path.join(cache_dir, f'{fingerprint(gtf, feature)[:16]}.npz')
+        if os.path.isfile(cache_file):
+            try:
+                return IntervalIndex.load(cache_file)
+            except Exception:
+                #unreadable (e.g. cut short by an older interrupted run), rebuilt
+                pass
 
-def exon_positions(gtf):
-    exons = {}
+    starts = defaultdict(lambda: array('q'))
+    ends = defaultdict(lambda: array('q'))
     with open(gtf) as fh:
         for line in fh:
             if line.startswith('#'):
                 continue
-            arr = line.split()
+            arr = line.split('\t', 5)
+            if feature != 'all' and arr[2] != feature:
+                continue
             scaffold = arr[0]
-            start = int(arr[3])
-            end = int(arr[4])
-            exons.setdefault(scaffold,[]).append([start,end])
+            starts[scaffold].append(int(arr[3]))
+            ends[scaffold].append(int(arr[4]))
+
+    exons = IntervalIndex()
+    for scaffold in starts:
+        exons.add(scaffold, np.column_stack([np.frombuffer(starts[scaffold], dtype=np.int64),
+            np.frombuffer(ends[scaffold], dtype=np.int64)]))
+    if cache_file:
+        exons.save(cache_file)
     return exons
 
-def grna_miner(rRNA_genes, PAM_list, GC_low=30, GC_high=70):
+def grna_miner(rRNA_genes, PAM, GC_low=30, GC_high=70, guide_length=20):
     guides = dict() # gRNA_seq : gRNA_id
     for rRNA in rRNA_genes:
         for sequence in rRNA_genes[rRNA]: #loops through the sequence of each copy of all rRNAs
-            PAMs_top = [] #PAM sequences in the top strand
-            PAMs_bot =  [] #PAM sequences in the bottom strand
-            for PAM_sequence in PAM_list:
-                PAMs_bot.extend(find_all(sequence, PAM_sequence))
-                PAMs_top.extend(find_all(sequence, revcomp(PAM_sequence)))
-
-            for PAM in PAMs_bot:
-                guide = retrieve_guide(PAM, "bot", sequence)
+            PAMs_bot, PAMs_top = find_pams(sequence, PAM) #PAM indexes on each strand
+
+            for PAM_index in PAMs_bot:
+                guide = retrieve_guide(PAM_index, "bot", sequence, guide_length, len(PAM))
                 if guide and guide not in guides:
                     if GC_low <= GC_count(guide) <= GC_high:
                         _id = gen_seq_id(rRNA)
                         guides[_id] = guide
                     else:
                         continue
-            for PAM in PAMs_top:
-                guide = retrieve_guide(PAM, "top", sequence)
+            for PAM_index in PAMs_top:
+                guide = retrieve_guide(PAM_index, "top", sequence, guide_length, len(PAM))
                 if guide and guide not in guides:
                     if GC_low <= GC_count(guide) <= GC_high:
                         _id = gen_seq_id(rRNA)
@@ -227,91 +320,186 @@ def grna_miner(rRNA_genes, PAM_list, GC_low=30, GC_high=70):
     return guides
 
 
-def discard_for_offtarget(bowtie_out, genome_seqs, positions, exons_pos, guides, PAM_list, PAM_length=3, guide_length=20):
-    revcomp_PAM_list = []
-    for PAM in PAM_list:
-        PAM = revcomp(PAM)
-        revcomp_PAM_list.append(PAM)
-    with open(bowtie_out) as fh, open('off_target.fa', 'w') as fo:
-        for row in fh:
-            arr = row.split()
-            scaffold = arr[2] #chromosome or plasmid ID
-            index = int(arr[3]) #starting index of off-target
-            if arr[1] == "+": #strand
-                start = index + guide_length
-                end = index + guide_length + PAM_length
-                discard = offtarget(PAM_list, genome_seqs, positions, exons_pos, scaffold, start, end, index)
-                                #this sequence as a true
-                                #off-target, the gRNA is
-                                #discarded and offtargeting
-                                #is increased by 1. Otherwise
-                                #by 0.
-            else:
-                start = index - PAM_length
-                end = index
-                discard = offtarget(revcomp_PAM_list, genome_seqs, positions, exons_pos, scaffold, start, end, index)
-
-            if discard:
-                try:
-                    fo.write(f'>{arr[0]}\n{guides[arr[0]]}\n')
-                    del guides[arr[0]]
-                except KeyError:
-                    continue
+def pam_flanked(pos, forward, seq, PAM, guide_length=20):
+    #boolean mask over hits (all on one scaffold with sequence seq) telling
+    #whether the hit is followed by the (ambiguous) PAM on its own strand
+    PAM_length = len(PAM)
+    starts = np.where(forward, pos + guide_length, pos - PAM_length)
+    inside = (starts >= 0) & (starts + PAM_length <= len(seq))
+    flanked = np.zeros(len(pos), dtype=bool)
+    if not inside.any():
+        return flanked
+    bits = BASE_BITS[seq[starts[inside, None] + np.arange(PAM_length)]]
+    is_fwd = (bits & pam_bitmask(PAM)).all(axis=1)
+    is_rev = (bits & pam_bitmask(revcomp(PAM))).all(axis=1)
+    flanked[inside] = np.where(forward[inside], is_fwd, is_rev)
+    return flanked
+
+def offtarget_shard(genome_seqs, scaffold, rows, pos, forward, rrna_index, exon_index, PAM, guide_length=20):
+    #rows of one scaffold's hits that are true off-targets: PAM-flanked,
+    #outside the rRNA genes and inside an exon. In a worker process
+    #genome_seqs is the store prefix, so only this scaffold's pages are read
+    if isinstance(genome_seqs, str):
+        genome_seqs = GenomeStore(genome_seqs)
+    true_off = ~rrna_index.contains_many(scaffold, pos) & exon_index.contains_many(scaffold, pos)
+    flanked = pam_flanked(pos[true_off], forward[true_off], genome_seqs.array(scaffold), PAM, guide_length)
+    return rows[true_off][flanked]
+
+def offtarget_rows(hits, genome_seqs, rrna_index, exon_index, PAM, guide_length=20, threads=1, pool=None):
+    #boolean mask of the true off-target hits of a table. With threads > 1
+    #the hits are sharded by scaffold over a process pool, created on first
+    #use and returned for the next table
+    shards = []
+    for code, scaffold in enumerate(hits.scaffolds):
+        if scaffold not in rrna_index:
+            continue
+        rows = np.flatnonzero(hits.scaffold == code)
+        shards.append((scaffold, rows, hits.pos[rows], hits.forward[rows]))
+
+    discard = np.zeros(len(hits), dtype=bool)
+    if threads > 1 and len(shards) > 1:
+        #largest shards first, each worker gets only its scaffold's intervals
+        shards.sort(key=lambda shard: -len(shard[1]))
+        args = [(genome_seqs.prefix, scaffold, rows, pos, forward, rrna_index.subset(scaffold),
+            exon_index.subset(scaffold), PAM, guide_length) for scaffold, rows, pos, forward in shards]
+        pool = pool or Pool(processes=threads)
+        for rows in pool.starmap(offtarget_shard, args, chunksize=1):
+            discard[rows] = True
+    else:
+        for scaffold, rows, pos, forward in shards:
+            discard[offtarget_shard(genome_seqs, scaffold, rows, pos, forward, rrna_index, exon_index, PAM, guide_length)] = True
+    return discard, pool
+
+def discard_for_offtarget(hits, genome_seqs, rrna_index, exon_index, guides, PAM, guide_length=20, threads=1, off_target_fa='off_target.fa'):
+    #a true off-target hit discards its guide. hits is a table or an
+    #iterable of tables (hit_chunks), each filtered as it arrives
+    chunks = [hits] if isinstance(hits, HitTable) else hits
+    discarded = dict() #guide id -> None, in the order of its first discarding hit
+    pool = None
+    try:
+        for table in chunks:
+            discard, pool = offtarget_rows(table, genome_seqs, rrna_index, exon_index, PAM, guide_length, threads, pool)
+            guide_idx, first = np.unique(table.guide[discard], return_index=True)
+            for g in guide_idx[np.argsort(first)].tolist():
+                discarded.setdefault(table.guide_ids[g])
+    finally:
+        if pool:
+            pool.terminate()
+
+    with open(off_target_fa, 'w') as fo:
+        for _id in discarded:
+            try:
+                fo.write(f'>{_id}\n{guides[_id]}\n')
+                del guides[_id]
+            except KeyError:
+                continue
     return guides
 
-def clapse_by_density(guides, bowtie_out):
-    input_fa = 'input.fa'
+def screen_offtargets(guides, search, genome_seqs, rrna_index, exon_index, PAM, guide_length=20, cache=None, cache_hits=False, threads=1, off_target_fa='off_target.fa', hits_out=None):
+    #discard_for_offtarget on the guides whose spacer has no cached verdict.
+    #When some verdicts come from the cache, hits_out (the file the search
+    #wrote its hits to) is rewritten with the hits of all guides.
+    #search(guides) returns the hits output (or table) of the off-target search;
+    #hit lines are filtered in chunks while the search is still running.
+    #Returns the surviving guides and the hit table of all guides
+    found = cache.offtarget_lookup(guides.values()) if cache else dict()
+    misses = {_id: seq for _id, seq in guides.items() if seq not in found}
+    tables = []
+    def chunks():
+        for table in hit_chunks(search(misses), cache=cache_hits):
+            tables.append(table)
+            yield table
+    kept = discard_for_offtarget(chunks() if misses else [], genome_seqs, rrna_index, exon_index, dict(misses),
+        PAM, guide_length, threads, off_target_fa)
+    hits = tables[0] if len(tables) == 1 else concat_hits(tables)
+
+    if cache:
+        order = np.argsort(hits.guide, kind='stable')
+        bounds = np.searchsorted(hits.guide[order], np.arange(len(hits.guide_ids) + 1))
+        codes = {_id: g for g, _id in enumerate(hits.guide_ids)}
+        stored = set()
+        for _id, spacer in misses.items():
+            if spacer in stored:
+                continue
+            stored.add(spacer)
+            rows = []
+            if _id in codes:
+                g = codes[_id]
+                rows = order[bounds[g]:bounds[g+1]]
+            spacer_hits = zip(hits.forward[rows].tolist(), [hits.scaffolds[c] for c in hits.scaffold[rows]],
+                hits.pos[rows].tolist(), hits.mismatches[rows].tolist())
+            cache.offtarget_store(spacer, _id not in kept, spacer_hits)
+        cache.commit()
+
+        with open(off_target_fa, 'a') as fo:
+            for _id, spacer in guides.items():
+                if spacer in found and found[spacer][0]:
+                    fo.write(f'>{_id}\n{spacer}\n')
+        cached_guides = {_id: seq for _id, seq in guides.items() if seq in found}
+        #cached and searched hits in guide order, as a search of all guides
+        #reports them; the density collapse depends on this order
+        hits = concat_hits([hits, cache.cached_hits(cached_guides, found)]).in_order(guides)
+        if hits_out and cached_guides:
+            write_hits(hits_out, hits, guides, genome_seqs)
+
+    survivors = {_id: seq for _id, seq in guides.items()
+        if _id in kept or (seq in found and not found[seq][0])}
+    print(f'{len(guides) - len(survivors)} guides discarded for off-targets '
+        f'({len(misses)} searched, {len(guides) - len(misses)} from cache).')
+    return survivors, hits
+
+def clapse_by_density(guides, hits, window=50, input_fa='input.fa'):
+    #among hits of the guides closer than window bp to the current anchor hit,
+    #the position of the guide with fewer hit positions is discarded (see
+    #discard_for_dense); guides keeping at least one position survive.
+    #Every hit counts, PAM-flanked or not, so bowtie hits and the PAM-flanked
+    #hits of the builtin engine can give different survivors
     with open(input_fa, 'w') as fh:
         for _id, seq in guides.items():
             fh.write(f'>{_id}\n{seq}\n')
 
-    grna_positions = defaultdict(list)
-    grna_db = dict()
-    with open(bowtie_out) as fh:
-        for line in fh:
-            arr = line.split()
-            scaffold = arr[2] #chromosome or plasmid ID
-            index = int(arr[3]) #starting index of off-target
-            if arr[0] not in guides:
-                continue
-            insort_left(grna_positions[scaffold], index)
-            grna_db[(scaffold, index)] = arr[0]
-    counter = Counter(grna_db.values())
-
-    discard_pos = []
-    for scaffold, positions_sorted in grna_positions.items():
-        i, j = 0, 1
-        while j < len(positions_sorted):
-            if positions_sorted[j] - positions_sorted[i] > 50:
-                i = j
-                j += 1
-                continue
-            else:
-                discarded = discard_for_dense(scaffold, positions_sorted[i], positions_sorted[j], grna_db, counter)
-                discard_pos.append((scaffold, discarded))
-                j += 1
+    rows = np.flatnonzero(hits.guide_mask(guides))
+    if len(rows) == 0:
+        return dict()
+    #one integer key per (scaffold, position), owned by the last hit there
+    keys = hits.scaffold[rows].astype(np.int64) * (int(hits.pos.max()) + 1) + hits.pos[rows]
+    uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    last = len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]
+    owner = hits.guide[rows][last]
+    counter = np.bincount(owner, minlength=len(hits.guide_ids)) #positions per guide
+
+    #single sweep over all hit positions sorted by scaffold and position
+    order = np.argsort(keys, kind='stable')
+    key_sorted = keys[order].tolist()
+    scaffold_sorted = hits.scaffold[rows][order].tolist()
+    pos_sorted = hits.pos[rows][order].tolist()
+    count_sorted = counter[owner[inverse[order]]].tolist()
+    discard_pos = set()
+    i = 0
+    for j in range(1, len(key_sorted)):
+        if scaffold_sorted[j] != scaffold_sorted[i] or pos_sorted[j] - pos_sorted[i] > window:
+            i = j
+        else:
+            discard_pos.add(discard_for_dense(i, j, key_sorted, count_sorted))
 
+    #survivors in the order their first position was reported
+    kept = ~np.isin(uniq, np.fromiter(discard_pos, dtype=np.int64, count=len(discard_pos)))
+    first_order = np.argsort(first)
     new_dict = dict()
-    for _pos, _id in grna_db.items():
-        if _pos in discard_pos:
-            continue
-        try:
+    for g in owner[first_order[kept[first_order]]].tolist():
+        _id = hits.guide_ids[g]
+        if _id not in new_dict:
             new_dict[_id] = guides[_id]
-        except KeyError:
-            continue
-
     return new_dict
 
-def discard_for_dense(scaffold, i, j, grna_db, counter):
-    grna1 = grna_db[(scaffold, i)]
-    grna2 = grna_db[(scaffold, j)]
-
-    if counter[grna1] > counter[grna2]:
-        return j
+def discard_for_dense(i, j, keys, counts):
+    #the position of the guide with fewer hit positions goes, i on ties
+    if counts[i] > counts[j]:
+        return keys[j]
     else:
-        return i
+        return keys[i]
 
-def discard_for_dimer(guides):
+def discard_for_dimer(guides, threads=1, verbose=False, cache=None, het_tm=40, end_tm=30, chunk_size=64):
     T7 = "TTCTAATACGACTCACTATA" #T7 promoter (minus the first G)
     scaff = "GTTTTAGAGCTAGAAATAGCAAGTTAAAATAAGGCTAGTCCGTTATCAACTTGAAAAAGTGGCACCGAGTCGGTGCTTTTTT"
     #scaff is the Cas9 sgRNA scaffold
@@ -319,30 +507,137 @@ def discard_for_dimer(guides):
                     #gets added to the sgRNA template oligos.
     primer_revcomp = revcomp(primer)
 
-    for _id, sequence in list(guides.items()):
+    oligos = dict()
+    for _id, sequence in guides.items():
         if sequence[0] == "G":
             if sequence[1] == "G": #starts with two G
-                oligo = T7 + sequence + scaff + primer_revcomp
-                ID = primer_heterodimer(oligo[:-len(primer_revcomp)], primer_revcomp)
+                oligos[_id] = T7 + sequence + scaff
             else: #starts with only one G
-                oligo = T7 + "G" + sequence + scaff + primer_revcomp
-                ID = primer_heterodimer(oligo[:-len(primer_revcomp)], primer_revcomp)
+                oligos[_id] = T7 + "G" + sequence + scaff
         else:
-            oligo = T7 + "GG" + sequence + scaff + primer_revcomp
-            ID = primer_heterodimer(oligo[:-len(primer_revcomp)], primer_revcomp)
-        
-        if ID:
-            try:
-                del guides[_id]
-            except KeyError:
-                continue
+            oligos[_id] = T7 + "GG" + sequence + scaff
+
+    #only oligos never screened with these thresholds go to primer3.
+    #Cache keys include the fill-in primer
+    verdicts = dict()
+    todo = []
+    for oligo in sorted(set(oligos.values())):
+        discard = cache.dimer_lookup(oligo + primer_revcomp, het_tm, end_tm) if cache else None
+        if discard is None:
+            todo.append(oligo)
+        else:
+            verdicts[oligo] = discard
+    chunks = [todo[i:i+chunk_size] for i in range(0, len(todo), chunk_size)]
+    args = [(chunk, primer_revcomp, het_tm, end_tm, verbose) for chunk in chunks]
+    if threads > 1 and len(chunks) > 1:
+        with Pool(processes=threads) as pool:
+            results = pool.starmap(heterodimer_chunk, args)
+    else:
+        results = [heterodimer_chunk(*arg) for arg in args]
+
+    for chunk, chunk_results in zip(chunks, results):
+        for oligo, (discard, report) in zip(chunk, chunk_results):
+            verdicts[oligo] = discard
+            if report:
+                print(report)
+            if cache:
+                cache.dimer_store(oligo + primer_revcomp, het_tm, end_tm, discard)
+    if cache:
+        cache.commit()
+
+    n = 0
+    for _id, oligo in oligos.items():
+        if verdicts[oligo]:
+            del guides[_id]
+            n += 1
+    print(f'{n} guides discarded for primer dimers ({len(todo)} oligos screened, '
+        f'{len(verdicts) - len(todo)} from cache).')
     return guides
 
+class CheckHandler(socketserver.StreamRequestHandler):
+    #one request per connection: FASTA of spacers until the client shuts
+    #down its side, answered with one "id, spacer, verdict" line per spacer
+    def handle(self):
+        text = self.rfile.read().decode()
+        try:
+            guides = {record.id: str(record.seq).upper() for record in SeqIO.parse(StringIO(text), 'fasta')}
+            lines = [f'{_id}\t{spacer}\t{verdict}\n' for _id, spacer, verdict in self.server.check(guides)]
+        except Exception as e:
+            lines = [f'#error\t{e}\n']
+        self.wfile.write(''.join(lines).encode())
+
+class GuideServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    #keeps the genome store, interval indexes and off-target index loaded and
+    #screens spacers like the offtarget command followed by the dimer screen.
+    #Only the builtin engine stays loaded; with bowtie each request starts a
+    #bowtie process that loads the index from disk again
+    daemon_threads = True
+
+    def __init__(self, socket_path, genome_seqs, rrna_index, exon_index, PAM, engine, bowtie_idx,
+            cache_path=None, cache_key='', threads=1, guide_length=20):
+        self.genome_seqs = genome_seqs
+        self.rrna_index = rrna_index
+        self.exon_index = exon_index
+        self.PAM = PAM
+        self.bowtie_idx = bowtie_idx
+        self.cache_path = cache_path
+        self.cache_key = cache_key
+        self.threads = threads
+        self.guide_length = guide_length
+        self.pam_index = open_pam_index(genome_seqs, PAM, guide_length) if engine == 'builtin' else None
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, CheckHandler)
+
+    def search(self, guides):
+        #hit lines of guides; bowtie files are private to the request
+        if self.pam_index is not None:
+            return self.pam_index.search(guides)
+        return self.bowtie_hits(guides)
+
+    def bowtie_hits(self, guides):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_fa = prepare_for_bowtie(guides, os.path.join(tmp, 'input.fa'))
+            yield from stream_bowtie(input_fa, self.bowtie_idx, self.threads)
+
+    def check(self, guides):
+        #(id, spacer, verdict) per guide, verdict being pass, off_target or
+        #dimer. Each request has its own cache connection; the filters run
+        #in this thread, only bowtie uses several threads
+        cache = GuideCache(self.cache_path, self.cache_key) if self.cache_path else None
+        try:
+            kept, hits = screen_offtargets(guides, self.search, self.genome_seqs, self.rrna_index,
+                self.exon_index, self.PAM, self.guide_length, cache, off_target_fa=os.devnull)
+            passed = discard_for_dimer(dict(kept), cache=cache)
+        finally:
+            if cache:
+                cache.close()
+        for _id, spacer in guides.items():
+            if _id in passed:
+                yield _id, spacer, 'pass'
+            elif _id in kept:
+                yield _id, spacer, 'dimer'
+            else:
+                yield _id, spacer, 'off_target'
+
+def check_guides(socket_path, gfa):
+    #client of GuideServer, returns its reply lines
+    with open(gfa) as fh:
+        text = fh.read()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(text.encode())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile() as fh:
+            return fh.readlines()
+
 def main(args):
     if args.command == 'solo':
         GC_low = args.minGC
         GC_high = args.maxGC
         guide_length = args.length
+        if args.engine == 'builtin' and guide_length > MAX_GUIDE_LENGTH:
+            sys.exit(f'--engine builtin searches spacers of up to {MAX_GUIDE_LENGTH} bp, not {guide_length}')
         show_offtargets = args.offtargets
         rna_bed = args.manual_ann
         PAM = args.pam.upper()
@@ -350,29 +645,58 @@ def main(args):
         gtf = args.gtf
         bowtie_idx = args.bowtie_index
         grnas = args.grnas
+        genome_store = args.genome_store
+        threads = args.threads
 
         PAM_length = len(PAM)
-        PAM_list = remove_ambiguous(PAM)
 
         grna_candidates = dict()
 
-        rRNA_genes, positions, genome_seqs = enumerate_rrna_regions(genome_fa, rna_bed)
-        if not bowtie_idx:
-            bowtie_idx = build_index(genome_fa)
-
-        guides = grna_miner(rRNA_genes, PAM_list)
-        input_fa = prepare_for_bowtie(guides)
-        bowtie_out = run_bowtie(input_fa, bowtie_idx)
-        exons_pos = exon_positions(gtf)
-        guides = discard_for_offtarget(bowtie_out, genome_seqs, positions, exons_pos, guides, PAM_list)
+        recorder = StageRecorder(args.profile, args.profile_out)
+        with recorder.stage('load_genome') as rec:
+            rRNA_genes, positions, genome_seqs = enumerate_rrna_regions(genome_fa, rna_bed, genome_store)
+            rec['items_out'] = sum(len(seqs) for seqs in rRNA_genes.values())
+        if not bowtie_idx and args.engine == 'bowtie':
+            with recorder.stage('bowtie_index'):
+                bowtie_idx = build_index(genome_fa, threads, args.index_digest, args.index_dir)
+
+        with recorder.stage('mine') as rec:
+            guides = grna_miner(rRNA_genes, PAM, GC_low, GC_high, guide_length)
+            rec['items_out'] = len(guides)
+        recorder.count(guides_mined=len(guides))
+        with recorder.stage('exon_index'):
+            rrna_index = IntervalIndex(positions)
+            exon_index = exon_positions(gtf, args.gtf_feature, args.gtf_cache)
+        cache = None
+        if not args.no_cache:
+            cache = GuideCache(args.cache, fingerprint(genome_fa, bowtie_idx, gtf, args.gtf_feature, rna_bed, PAM, guide_length, args.engine))
+        #streamed hits are still written to bowtie.csv, as in non-streaming runs.
+        #A streamed search runs on while offtarget filters its hits, the
+        #search stage then only covers its start
+        def search(misses):
+            with recorder.stage('search', items_in=len(misses)):
+                return search_offtargets(misses, args.engine, genome_seqs, bowtie_idx, PAM,
+                    guide_length, threads, args.stream, tee='bowtie.csv')
+        with recorder.stage('offtarget', items_in=len(guides)) as rec:
+            guides, hits = screen_offtargets(guides, search, genome_seqs, rrna_index, exon_index, PAM,
+                guide_length, cache, args.cache_hits, threads, hits_out='bowtie.csv')
+            rec['items_out'] = len(guides)
+        recorder.count(hits_parsed=len(hits), discarded_offtarget=rec['items_in'] - rec['items_out'])
         #guides = read_guids(grnas)
-        guides = discard_for_dimer(guides)
-        bowtie_out = 'bowtie.csv'
-        grna_remained = clapse_by_density(guides, bowtie_out)
+        with recorder.stage('dimer', items_in=len(guides)) as rec:
+            guides = discard_for_dimer(guides, threads, args.verbose, cache)
+            rec['items_out'] = len(guides)
+        recorder.count(discarded_dimer=rec['items_in'] - rec['items_out'])
+        with recorder.stage('density', items_in=len(guides)) as rec:
+            grna_remained = clapse_by_density(guides, hits, args.window)
+            rec['items_out'] = len(grna_remained)
+        recorder.count(discarded_density=rec['items_in'] - rec['items_out'], survivors=len(grna_remained))
 
         with open('guides.fa', 'w') as fh:
             for _id, seq in grna_remained.items():
                 fh.write(f'>{_id}\n{seq}\n')
+        if args.metrics:
+            recorder.save(args.metrics)
 
     if args.command == 'offtarget':
         genome_fa = args.genome
@@ -381,16 +705,121 @@ def main(args):
         grnas = args.grnas
         bowtie_idx = args.bowtie_index
         rna_bed = args.region
+        genome_store = args.genome_store
+        threads = args.threads
+
+        recorder = StageRecorder(args.profile, args.profile_out)
+        with recorder.stage('load_genome') as rec:
+            rRNA_genes, positions, genome_seqs = enumerate_rrna_regions(genome_fa, rna_bed, genome_store)
+            rec['items_out'] = sum(len(seqs) for seqs in rRNA_genes.values())
+        with recorder.stage('exon_index'):
+            rrna_index = IntervalIndex(positions)
+            exon_index = exon_positions(gtf, args.gtf_feature, args.gtf_cache)
+        guides = {_id: str(seq) for _id, seq in read_guids(grnas).items()}
+        n_guides = len(guides)
+        if args.hits:
+            with recorder.stage('search') as rec:
+                hits = load_hits(args.hits, cache=args.cache_hits)
+                rec['items_out'] = len(hits)
+            with recorder.stage('offtarget', items_in=n_guides) as rec:
+                guides = discard_for_offtarget(hits, genome_seqs, rrna_index, exon_index, guides, PAM, threads=threads)
+                rec['items_out'] = len(guides)
+        else:
+            if not bowtie_idx and args.engine == 'bowtie':
+                with recorder.stage('bowtie_index'):
+                    bowtie_idx = build_index(genome_fa, threads, args.index_digest, args.index_dir)
+            cache = None
+            if not args.no_cache:
+                cache = GuideCache(args.cache, fingerprint(genome_fa, bowtie_idx, gtf, args.gtf_feature, rna_bed, PAM, 20, args.engine))
+            def search(misses):
+                with recorder.stage('search', items_in=len(misses)):
+                    return search_offtargets(misses, args.engine, genome_seqs, bowtie_idx, PAM,
+                        threads=threads, stream=args.stream, tee=args.tee_hits)
+            with recorder.stage('offtarget', items_in=n_guides) as rec:
+                guides, hits = screen_offtargets(guides, search, genome_seqs, rrna_index, exon_index, PAM, cache=cache,
+                    cache_hits=args.cache_hits, threads=threads)
+                rec['items_out'] = len(guides)
+        recorder.count(guides_read=n_guides, hits_parsed=len(hits), discarded_offtarget=n_guides - len(guides),
+            survivors=len(guides))
+        if args.metrics:
+            recorder.save(args.metrics)
+
+    if args.command == 'serve':
+        genome_fa = args.genome
+        gtf = args.gtf
+        PAM = args.pam.upper()
+        bowtie_idx = args.bowtie_index
+        rna_bed = args.region
 
-        PAM_list = remove_ambiguous(PAM)
-
-        rRNA_genes, positions, genome_seqs = enumerate_rrna_regions(genome_fa, rna_bed)
-        exons = exon_positions(gtf)
-        if not bowtie_idx:
-            bowtie_idx = build_index(genome_fa)
-        bowtie_out = run_bowtie(grnas, bowtie_idx)
-        guides = read_guids(grnas)
-        discard_for_offtarget(bowtie_out, genome_seqs, positions, exons, guides, PAM_list)
+        rRNA_genes, positions, genome_seqs = enumerate_rrna_regions(genome_fa, rna_bed, args.genome_store)
+        rrna_index = IntervalIndex(positions)
+        exon_index = exon_positions(gtf, args.gtf_feature, args.gtf_cache)
+        if not bowtie_idx and args.engine == 'bowtie':
+            bowtie_idx = build_index(genome_fa, args.threads, args.index_digest, args.index_dir)
+        #same cache key as the offtarget command, so verdicts are shared
+        cache_key = fingerprint(genome_fa, bowtie_idx, gtf, args.gtf_feature, rna_bed, PAM, 20, args.engine)
+        server = GuideServer(args.socket, genome_seqs, rrna_index, exon_index, PAM, args.engine, bowtie_idx,
+            None if args.no_cache else args.cache, cache_key, args.threads)
+        print(f'Serving on {args.socket}.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(args.socket)
+
+    if args.command == 'check':
+        for line in check_guides(args.socket, args.grnas):
+            if line.startswith('#error'):
+                sys.exit(line.split('\t', 1)[1].strip())
+            sys.stdout.write(line)
+
+    if args.command == 'batch':
+        genome_fa = args.genome
+        gtf = args.gtf
+        bowtie_idx = args.bowtie_index
+        threads = args.threads
+
+        #genome, exon intervals and index are loaded once for all jobs
+        jobs = read_manifest(args.manifest)
+        for job in jobs:
+            if args.engine == 'builtin' and job['length'] > MAX_GUIDE_LENGTH:
+                sys.exit(f'{job["prefix"]}: --engine builtin searches spacers of up to {MAX_GUIDE_LENGTH} bp, '
+                    f'not {job["length"]}')
+        genome_seqs = open_genome(genome_fa, args.genome_store)
+        exon_index = exon_positions(gtf, args.gtf_feature, args.gtf_cache)
+        if not bowtie_idx and args.engine == 'bowtie':
+            bowtie_idx = build_index(genome_fa, threads, args.index_digest, args.index_dir)
+
+        misses = dict()
+        for job in jobs:
+            rRNA_genes, positions = read_rrna_regions(genome_seqs, job['bed'])
+            job['rrna_index'] = IntervalIndex(positions)
+            job['guides'] = grna_miner(rRNA_genes, job['pam'], job['minGC'], job['maxGC'], job['length'])
+            job['cache'] = None
+            if not args.no_cache:
+                job['cache'] = GuideCache(args.cache, fingerprint(genome_fa, bowtie_idx, gtf, args.gtf_feature,
+                    job['bed'], job['pam'], job['length'], args.engine))
+            found = job['cache'].offtarget_lookup(job['guides'].values()) if job['cache'] else dict()
+            misses.update((_id, seq) for _id, seq in job['guides'].items() if seq not in found)
+
+        #a single off-target search, split back per job by guide id
+        hits = search_batch(misses, jobs, args.engine, genome_seqs, bowtie_idx, threads) if misses else concat_hits([])
+        for job in jobs:
+            prefix = job['prefix']
+            search = lambda job_misses: hits.take(np.flatnonzero(hits.guide_mask(job_misses)))
+            guides, job_hits = screen_offtargets(job['guides'], search, genome_seqs, job['rrna_index'], exon_index,
+                job['pam'], job['length'], job['cache'], threads=threads, off_target_fa=f'{prefix}.off_target.fa')
+            guides = discard_for_dimer(guides, threads, args.verbose, job['cache'])
+            grna_remained = clapse_by_density(guides, job_hits, args.window, f'{prefix}.input.fa')
+
+            with open(f'{prefix}.guides.fa', 'w') as fh:
+                for _id, seq in grna_remained.items():
+                    fh.write(f'>{_id}\n{seq}\n')
+            print(f'{prefix}: {len(job["guides"])} guides mined, {len(grna_remained)} kept.')
+            if job['cache']:
+                job['cache'].close()
 
 
 
@@ -408,12 +837,16 @@ if __name__ == '__main__':
     meta_parser.add_argument('--minGC', '-g', default=30, type=int,
                         help='Minimal accepted GC%% of a spacer (Default: 30).')
 
-    meta_parser.add_argument('--maxGC', '-G', default=80, type=int,
-                        help='Maximal accepted GC%% of a spacer (Default: 80).')
+    meta_parser.add_argument('--maxGC', '-G', default=70, type=int,
+                        help='Maximal accepted GC%% of a spacer (Default: 70).')
 
     meta_parser.add_argument('--length', '-l', default=20, type=int,
                         help='Spacer length (Default: 20).')
 
+    meta_parser.add_argument('--window', '-w', default=50, type=int,
+                        help='Hits of different guides closer than this many bp are collapsed, '
+                        'keeping the guide with more hit positions (Default: 50).')
+
     meta_parser.add_argument('--offtargets', '-o', default=False, action='store_true',
                         help='Print the spacers that were discarded because of off-targeting.')
 
@@ -430,11 +863,64 @@ if __name__ == '__main__':
     meta_parser.add_argument('--bowtie_index', '-index', default=False, type=str,
                         help='Bowtie index of the genome')
 
+    meta_parser.add_argument('--index_dir', default='bowtie_files', type=str,
+                        help='Directory of the bowtie indexes built when --bowtie_index is not given '
+                        '(Default: bowtie_files).')
+
+    meta_parser.add_argument('--index_digest', default=False, action='store_true',
+                        help='Identify the genome by a digest of its content instead of its '
+                        'path, size and mtime when looking for a built index.')
+
+    meta_parser.add_argument('--genome_store', '-store', default=None, type=str,
+                        help='Prefix of the packed genome store, built on first use '
+                        '(Default: <genome>.gstore).')
+
+    meta_parser.add_argument('--threads', '-t', default=1, type=int,
+                        help='Number of threads used by bowtie, bowtie-build, the off-target filter '
+                        'and the primer dimer screen (Default: 1).')
+
+    meta_parser.add_argument('--stream', default=False, action='store_true',
+                        help='Filter the bowtie hits while bowtie is still running.')
+
+    meta_parser.add_argument('--engine', default='bowtie', choices=['bowtie', 'builtin'],
+                        help='Off-target search: the bowtie binary, or the built-in index of '
+                        'PAM-flanked sites, which reports only PAM-flanked hits. The density '
+                        'collapse counts every reported hit, so the two engines can keep '
+                        'different guides (Default: bowtie).')
+
+    meta_parser.add_argument('--verbose', '-v', default=False, action='store_true',
+                        help='Print the primer3 report of every guide discarded for primer dimers.')
+
+    meta_parser.add_argument('--cache', default='guide_cache.sqlite', type=str,
+                        help='SQLite file keeping per-guide off-target and primer dimer verdicts '
+                        'across runs (Default: guide_cache.sqlite).')
+
+    meta_parser.add_argument('--no_cache', default=False, action='store_true',
+                        help='Screen every guide again, without reading or writing the verdict cache.')
+
+    meta_parser.add_argument('--cache_hits', default=False, action='store_true',
+                        help='Save the parsed bowtie hits next to bowtie.csv (bowtie.csv.npz).')
+
     meta_parser.add_argument('--gtf', '-gtf', default=False, type=str,
                         help='A gtf file to define rRNA regions')
+    meta_parser.add_argument('--gtf_feature', default='exon', type=str,
+                        help='GTF feature type counted as exonic, "all" for every line (Default: exon).')
+
+    meta_parser.add_argument('--gtf_cache', default='gtf_cache', type=str,
+                        help='Directory caching the merged GTF intervals between runs (Default: gtf_cache).')
+
     meta_parser.add_argument('--grnas', '-grnas', default=False, type=str,
                         help='sgRNAs in fasta format')
 
+    meta_parser.add_argument('--metrics', default=None, type=str,
+                        help='Write wall time, CPU time, memory and item counts of each stage to this JSON file.')
+
+    meta_parser.add_argument('--profile', default=None, type=str,
+                        help='Run this stage (e.g. offtarget, offtarget/search, dimer) under cProfile.')
+
+    meta_parser.add_argument('--profile_out', default=None, type=str,
+                        help='cProfile dump of --profile (Default: <stage>.prof).')
+
     # subparser for off target detect
     off_parser = AP_subparsers.add_parser('offtarget', help='Remove off target gRNAs')
     off_parser.add_argument('--genome', '-ref', default=False, type=str,
@@ -446,6 +932,12 @@ if __name__ == '__main__':
     off_parser.add_argument('--gtf', '-gtf', default=False, type=str,
                         help='A gtf file to define rRNA regions')
 
+    off_parser.add_argument('--gtf_feature', default='exon', type=str,
+                        help='GTF feature type counted as exonic, "all" for every line (Default: exon).')
+
+    off_parser.add_argument('--gtf_cache', default='gtf_cache', type=str,
+                        help='Directory caching the merged GTF intervals between runs (Default: gtf_cache).')
+
     off_parser.add_argument('--region', '-region', default=False, type=str,
                         help='A gtf file to define rRNA regions')
 
@@ -455,6 +947,171 @@ if __name__ == '__main__':
     off_parser.add_argument('--bowtie_index', '-index', default=False, type=str,
                 help='Bowtie index of the genome')
 
+    off_parser.add_argument('--index_dir', default='bowtie_files', type=str,
+                        help='Directory of the bowtie indexes built when --bowtie_index is not given '
+                        '(Default: bowtie_files).')
+
+    off_parser.add_argument('--index_digest', default=False, action='store_true',
+                        help='Identify the genome by a digest of its content instead of its '
+                        'path, size and mtime when looking for a built index.')
+
+    off_parser.add_argument('--threads', '-t', default=1, type=int,
+                        help='Number of threads used by bowtie, bowtie-build and the off-target filter (Default: 1).')
+
+    off_parser.add_argument('--stream', default=False, action='store_true',
+                        help='Filter the bowtie hits while bowtie is still running.')
+
+    off_parser.add_argument('--tee_hits', default=None, type=str,
+                        help='With --stream, also write the raw bowtie hits to this file.')
+
+    off_parser.add_argument('--engine', default='bowtie', choices=['bowtie', 'builtin'],
+                        help='Off-target search: the bowtie binary, or the built-in index of '
+                        'PAM-flanked sites, which reports only PAM-flanked hits (Default: bowtie).')
+
+    off_parser.add_argument('--hits', default=None, type=str,
+                        help='Filter an existing bowtie output instead of running bowtie.')
+
+    off_parser.add_argument('--cache_hits', default=False, action='store_true',
+                        help='Keep the parsed bowtie hits in <hits>.npz and reuse them on later runs.')
+
+    off_parser.add_argument('--cache', default='guide_cache.sqlite', type=str,
+                        help='SQLite file keeping per-guide off-target and primer dimer verdicts '
+                        'across runs (Default: guide_cache.sqlite).')
+
+    off_parser.add_argument('--no_cache', default=False, action='store_true',
+                        help='Screen every guide again, without reading or writing the verdict cache.')
+
+    off_parser.add_argument('--genome_store', '-store', default=None, type=str,
+                        help='Prefix of the packed genome store, built on first use '
+                        '(Default: <genome>.gstore).')
+
+    off_parser.add_argument('--metrics', default=None, type=str,
+                        help='Write wall time, CPU time, memory and item counts of each stage to this JSON file.')
+
+    off_parser.add_argument('--profile', default=None, type=str,
+                        help='Run this stage (e.g. offtarget, offtarget/search, dimer) under cProfile.')
+
+    off_parser.add_argument('--profile_out', default=None, type=str,
+                        help='cProfile dump of --profile (Default: <stage>.prof).')
+
+    # subparser for batches of designs sharing one genome load
+    batch_parser = AP_subparsers.add_parser('batch', help='Design several sgRNA pools in one run')
+    batch_parser.add_argument('--manifest', '-m', required=True, type=str,
+                        help='Tab-separated jobs with a header: bed, prefix and optionally '
+                        'pam, length, minGC, maxGC.')
+
+    batch_parser.add_argument('--genome', '-ref', default=False, type=str,
+                        help='Fasta of genomes')
+
+    batch_parser.add_argument('--gtf', '-gtf', default=False, type=str,
+                        help='A gtf file to define exons')
+
+    batch_parser.add_argument('--gtf_feature', default='exon', type=str,
+                        help='GTF feature type counted as exonic, "all" for every line (Default: exon).')
+
+    batch_parser.add_argument('--gtf_cache', default='gtf_cache', type=str,
+                        help='Directory caching the merged GTF intervals between runs (Default: gtf_cache).')
+
+    batch_parser.add_argument('--bowtie_index', '-index', default=False, type=str,
+                        help='Bowtie index of the genome')
+
+    batch_parser.add_argument('--index_dir', default='bowtie_files', type=str,
+                        help='Directory of the bowtie indexes built when --bowtie_index is not given '
+                        '(Default: bowtie_files).')
+
+    batch_parser.add_argument('--index_digest', default=False, action='store_true',
+                        help='Identify the genome by a digest of its content instead of its '
+                        'path, size and mtime when looking for a built index.')
+
+    batch_parser.add_argument('--genome_store', '-store', default=None, type=str,
+                        help='Prefix of the packed genome store, built on first use '
+                        '(Default: <genome>.gstore).')
+
+    batch_parser.add_argument('--engine', default='bowtie', choices=['bowtie', 'builtin'],
+                        help='Off-target search: the bowtie binary, or the built-in index of '
+                        'PAM-flanked sites, which reports only PAM-flanked hits. The density '
+                        'collapse counts every reported hit, so the two engines can keep '
+                        'different guides (Default: bowtie).')
+
+    batch_parser.add_argument('--threads', '-t', default=1, type=int,
+                        help='Number of threads used by bowtie, bowtie-build, the off-target filter '
+                        'and the primer dimer screen (Default: 1).')
+
+    batch_parser.add_argument('--window', '-w', default=50, type=int,
+                        help='Hits of different guides closer than this many bp are collapsed, '
+                        'keeping the guide with more hit positions (Default: 50).')
+
+    batch_parser.add_argument('--verbose', '-v', default=False, action='store_true',
+                        help='Print the primer3 report of every guide discarded for primer dimers.')
+
+    batch_parser.add_argument('--cache', default='guide_cache.sqlite', type=str,
+                        help='SQLite file keeping per-guide off-target and primer dimer verdicts '
+                        'across runs (Default: guide_cache.sqlite).')
+
+    batch_parser.add_argument('--no_cache', default=False, action='store_true',
+                        help='Screen every guide again, without reading or writing the verdict cache.')
+
+    # subparser for the resident off-target service
+    serve_parser = AP_subparsers.add_parser('serve', help='Keep the genome loaded and screen sgRNAs sent by check')
+    serve_parser.add_argument('--socket', '-s', default='solo_gRNA.sock', type=str,
+                        help='Unix socket to listen on (Default: solo_gRNA.sock).')
+
+    serve_parser.add_argument('--genome', '-ref', default=False, type=str,
+                        help='Fasta of genomes')
+
+    serve_parser.add_argument('--pam', '-p', default="NGG", type=str,
+                        help='PAM sequence (Default: NGG).')
+
+    serve_parser.add_argument('--gtf', '-gtf', default=False, type=str,
+                        help='A gtf file to define exons')
+
+    serve_parser.add_argument('--gtf_feature', default='exon', type=str,
+                        help='GTF feature type counted as exonic, "all" for every line (Default: exon).')
+
+    serve_parser.add_argument('--gtf_cache', default='gtf_cache', type=str,
+                        help='Directory caching the merged GTF intervals between runs (Default: gtf_cache).')
+
+    serve_parser.add_argument('--region', '-region', default=False, type=str,
+                        help='A bed file of the rRNA regions')
+
+    serve_parser.add_argument('--bowtie_index', '-index', default=False, type=str,
+                        help='Bowtie index of the genome')
+
+    serve_parser.add_argument('--index_dir', default='bowtie_files', type=str,
+                        help='Directory of the bowtie indexes built when --bowtie_index is not given '
+                        '(Default: bowtie_files).')
+
+    serve_parser.add_argument('--index_digest', default=False, action='store_true',
+                        help='Identify the genome by a digest of its content instead of its '
+                        'path, size and mtime when looking for a built index.')
+
+    serve_parser.add_argument('--genome_store', '-store', default=None, type=str,
+                        help='Prefix of the packed genome store, built on first use '
+                        '(Default: <genome>.gstore).')
+
+    serve_parser.add_argument('--engine', default='builtin', choices=['bowtie', 'builtin'],
+                        help='Off-target search: the built-in index of PAM-flanked sites, kept in '
+                        'memory between requests, or the bowtie binary, started for each request '
+                        'and reloading its index every time (Default: builtin).')
+
+    serve_parser.add_argument('--threads', '-t', default=1, type=int,
+                        help='Number of threads used by bowtie for each request (Default: 1).')
+
+    serve_parser.add_argument('--cache', default='guide_cache.sqlite', type=str,
+                        help='SQLite file keeping per-guide off-target and primer dimer verdicts '
+                        'across runs (Default: guide_cache.sqlite).')
+
+    serve_parser.add_argument('--no_cache', default=False, action='store_true',
+                        help='Screen every guide again, without reading or writing the verdict cache.')
+
+    # subparser for the client of serve
+    check_parser = AP_subparsers.add_parser('check', help='Screen sgRNAs with a running serve')
+    check_parser.add_argument('--socket', '-s', default='solo_gRNA.sock', type=str,
+                        help='Unix socket of the server (Default: solo_gRNA.sock).')
+
+    check_parser.add_argument('--grnas', '-grnas', required=True, type=str,
+                        help='sgRNAs in fasta format')
+
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,54 @@
+import os
+import sys
+import random
+
+import pytest
+
+#tests import solo_gRNA and libs from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def synthetic_bam(tmp_path_factory):
+    #sorted, indexed BAM of reads with M, I, D, N and S operations, and the
+    #bed of intervals they fall in
+    pysam = pytest.importorskip('pysam')
+    rng = random.Random(11)
+    tmp = tmp_path_factory.mktemp('bam')
+    lengths = {'c1': 20000, 'c2': 6000}
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+        'SQ': [{'SN': name, 'LN': length} for name, length in lengths.items()]}
+    reads = []
+    for n in range(3000):
+        chrom = rng.choice(list(lengths))
+        cigar = []
+        if rng.random() < 0.3:
+            cigar.append((4, rng.randint(1, 90)))
+        for k in range(rng.randint(1, 3)):
+            if k:
+                cigar.append(rng.choice([(2, rng.randint(1, 6)), (3, rng.randint(20, 600)), (1, rng.randint(1, 4))]))
+            cigar.append((0, rng.randint(15, 80)))
+        if rng.random() < 0.3:
+            cigar.append((4, rng.randint(1, 90)))
+        span = sum(length for op, length in cigar if op in (0, 2, 3))
+        pos = rng.randint(0, lengths[chrom] - span - 1)
+        reads.append((list(lengths).index(chrom), pos, n, cigar))
+
+    bam = str(tmp / 'synthetic.bam')
+    with pysam.AlignmentFile(bam, 'wb', header=header) as fo:
+        for tid, pos, n, cigar in sorted(reads):
+            read = pysam.AlignedSegment(fo.header)
+            read.query_name = f'r{n}'
+            read.reference_id = tid
+            read.reference_start = pos
+            read.cigartuples = cigar
+            read.query_sequence = 'A' * sum(length for op, length in cigar if op in (0, 1, 4))
+            read.mapping_quality = 60
+            fo.write(read)
+    pysam.index(bam)
+
+    bed = str(tmp / 'intervals.bed')
+    with open(bed, 'w') as fo:
+        #unsorted, overlapping and touching the scaffold ends
+        fo.write('c1\t3000\t9000\tA\nc1\t0\t2500\tB\nc1\t8000\t12000\tC\nc2\t100\t5900\tD\nc1\t15000\t19900\tE\n')
+    return bam, bed
@@ -0,0 +1,43 @@
+import pytest
+
+from libs.coverage import Coverage, open_coverage, read_intervals
+from libs.process_bam import BamParser
+
+
+# Coverage.bin_counts, from the cached CIGAR blocks, against bin_count, one
+# fetch per bin.
+
+SETTINGS = [(100, 50, 50), (150, 30, 45), (60, 60, 0), (250, 100, 1000)]
+
+
+@pytest.mark.parametrize('bin_len, overlap, maxSoftClip', SETTINGS)
+def test_bin_counts_match_bin_count(synthetic_bam, bin_len, overlap, maxSoftClip):
+    bam, bed = synthetic_bam
+    coverage = Coverage.build(bam, bed, pad=1000)
+    parser = BamParser(bam, maxSoftClip)
+    total = 0
+    for chrom, start, end in read_intervals(bed):
+        expected = [parser.bin_count((chrom, s, s + bin_len)) for s in range(start, end, overlap)]
+        counts = coverage.bin_counts((chrom, start, end), bin_len, overlap, maxSoftClip).tolist()
+        assert counts == expected
+        total += sum(expected)
+    assert total > 0
+    parser.close()
+
+
+def test_bins_longer_than_pad(synthetic_bam):
+    bam, bed = synthetic_bam
+    coverage = Coverage.build(bam, bed, pad=100)
+    with pytest.raises(ValueError):
+        coverage.bin_counts(read_intervals(bed)[0], bin_len=200)
+
+
+def test_cache_round_trip(synthetic_bam, tmp_path):
+    bam, bed = synthetic_bam
+    built = open_coverage(str(tmp_path), bam, bed)
+    assert len(list(tmp_path.glob('*.cov.npz'))) == 1
+    loaded = open_coverage(str(tmp_path), bam, bed)
+    assert loaded.chroms == built.chroms
+    assert loaded.total_reads == built.total_reads
+    for region in read_intervals(bed):
+        assert loaded.bin_counts(region).tolist() == built.bin_counts(region).tolist()
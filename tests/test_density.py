@@ -0,0 +1,56 @@
+import os
+from bisect import insort_left
+from collections import defaultdict, Counter
+
+import pytest
+
+from solo_gRNA import read_guids, clapse_by_density
+from libs.hit_table import load_hits
+
+
+# The vectorized density collapse against the original line by line one, on
+# the bundled bowtie.csv and bm.grna.fa.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def reference_density(guides, bowtie_out, window=50):
+    #the collapse as first written: each position goes to the last guide
+    #reported there, the guide with fewer positions loses, i on ties
+    grna_positions = defaultdict(list)
+    grna_db = dict()
+    with open(bowtie_out) as fh:
+        for line in fh:
+            arr = line.split()
+            if arr[0] not in guides:
+                continue
+            insort_left(grna_positions[arr[2]], int(arr[3]))
+            grna_db[(arr[2], int(arr[3]))] = arr[0]
+    counter = Counter(grna_db.values())
+
+    discard_pos = set()
+    for scaffold, positions in grna_positions.items():
+        i = 0
+        for j in range(1, len(positions)):
+            if positions[j] - positions[i] > window:
+                i = j
+                continue
+            grna1 = grna_db[(scaffold, positions[i])]
+            grna2 = grna_db[(scaffold, positions[j])]
+            discard_pos.add((scaffold, positions[j] if counter[grna1] > counter[grna2] else positions[i]))
+
+    new_dict = dict()
+    for pos, _id in grna_db.items():
+        if pos not in discard_pos:
+            new_dict[_id] = guides[_id]
+    return new_dict
+
+@pytest.mark.parametrize('window', [50, 100_000, 10_000_000])
+@pytest.mark.parametrize('step', [1, 3])
+def test_matches_reference(tmp_path, step, window):
+    bowtie_out = os.path.join(ROOT, 'bowtie.csv')
+    guides = {_id: str(seq) for _id, seq in read_guids(os.path.join(ROOT, 'bm.grna.fa')).items()}
+    guides = dict(list(guides.items())[::step])
+    expected = reference_density(guides, bowtie_out, window)
+    survivors = clapse_by_density(dict(guides), load_hits(bowtie_out), window, str(tmp_path / 'input.fa'))
+    assert list(survivors.items()) == list(expected.items())
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from libs import faidx
+from libs.faidx import FastaIndex
+
+
+def write_fasta(path, text):
+    with open(path, 'wb') as fh:
+        fh.write(text)
+    return str(path)
+
+def test_last_line_without_newline(tmp_path):
+    #chr2 ends on a full length line with no trailing newline
+    fa = write_fasta(tmp_path / 'g.fa', b'>chr1\nACGTA\nCGTAC\nGT\n>chr2\nTTGCA\nAACCG')
+    fasta = FastaIndex(fa)
+    assert fasta.names == ['1', '2']
+    assert fasta.length('2') == 10
+    assert fasta.fetch('2', 3, 10) == 'CAAACCG'
+    assert fasta.fetch('1', 0, 12) == 'ACGTACGTACGT'
+    fasta.close()
+
+def test_uneven_lines_rejected(tmp_path):
+    fa = write_fasta(tmp_path / 'g.fa', b'>chr1\nACGTA\nCG\nTACGT\n')
+    with pytest.raises(ValueError):
+        FastaIndex(fa)
+
+def test_working_directory_index(tmp_path, monkeypatch):
+    #FASTAs with the same name in unwritable directories get their own
+    #index in the working directory, rebuilt when the FASTA changes
+    build_fai = faidx.build_fai
+    def next_to_fasta_fails(fa, fai, stamp=None):
+        if fai == f'{fa}.fai':
+            raise PermissionError(fai)
+        build_fai(fa, fai, stamp)
+    monkeypatch.setattr(faidx, 'build_fai', next_to_fasta_fails)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    fa_a = write_fasta(tmp_path / 'a' / 'g.fa', b'>chr1\nACGTACGTAC\nACGTACGTAC\n')
+    fa_b = write_fasta(tmp_path / 'b' / 'g.fa', b'>chr1\nTTTTTGGGGG\nCCCCC\n')
+    for fa, length, seq in ((fa_a, 20, 'ACGTA'), (fa_b, 15, 'TTTTT'), (fa_a, 20, 'ACGTA')):
+        fasta = FastaIndex(fa)
+        assert (fasta.length('1'), fasta.fetch('1', 0, 5)) == (length, seq)
+        fasta.close()
+    assert len([f for f in os.listdir(tmp_path) if f.endswith('.fai')]) == 2
+
+    write_fasta(tmp_path / 'b' / 'g.fa', b'>chr1\nGGGGG\n')
+    fasta = FastaIndex(fa_b)
+    assert (fasta.length('1'), fasta.fetch('1', 0, 5)) == (5, 'GGGGG')
+    fasta.close()
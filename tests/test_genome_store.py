@@ -0,0 +1,54 @@
+import os
+from multiprocessing import Pool
+
+from libs import genome_store
+from libs.genome_store import open_genome, store_prefix
+
+
+SEQ = 'ACGTACGTAC' * 50
+
+
+def write_genome(path, seq=SEQ):
+    with open(path, 'w') as fh:
+        fh.write(f'>chr1 test\n{seq}\n>chr2\nacgtn\n')
+    return str(path)
+
+def read_store(genome_fa):
+    genome_seqs = open_genome(genome_fa)
+    try:
+        return str(genome_seqs['chr1']), str(genome_seqs['chr2'])
+    finally:
+        genome_seqs.close()
+
+def test_concurrent_builds(tmp_path):
+    genome_fa = write_genome(tmp_path / 'genome.fa')
+    with Pool(processes=4) as pool:
+        results = pool.map(read_store, [genome_fa] * 8)
+    assert set(results) == {(SEQ, 'ACGTN')}
+    assert not [f for f in os.listdir(tmp_path) if f.endswith('.tmp')]
+
+def test_mismatched_pair_rebuilt(tmp_path):
+    #a .seq replaced without its .idx, as after an interrupted build
+    genome_fa = write_genome(tmp_path / 'genome.fa')
+    read_store(genome_fa)
+    prefix = store_prefix(genome_fa)
+    with open(f'{prefix}.seq', 'ab') as fh:
+        fh.write(b'ACGT')
+    assert read_store(genome_fa) == (SEQ, 'ACGTN')
+
+def test_unwritable_fasta_directory(tmp_path, monkeypatch):
+    ensure_store = genome_store.ensure_store
+    def next_to_fasta_fails(genome_fa, prefix):
+        if prefix == store_prefix(genome_fa):
+            raise PermissionError(prefix)
+        return ensure_store(genome_fa, prefix)
+    monkeypatch.setattr(genome_store, 'ensure_store', next_to_fasta_fails)
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'work').mkdir()
+    monkeypatch.chdir(tmp_path / 'work')
+    fa_a = write_genome(tmp_path / 'a' / 'genome.fa')
+    fa_b = write_genome(tmp_path / 'b' / 'genome.fa', 'T' * 20)
+    assert read_store(fa_a)[0] == SEQ
+    assert read_store(fa_b)[0] == 'T' * 20
+    assert len([f for f in os.listdir('.') if f.endswith('.gstore.seq')]) == 2
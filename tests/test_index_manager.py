@@ -0,0 +1,68 @@
+import os
+import stat
+
+import pytest
+
+from libs.index_manager import ensure_index, index_files
+
+
+# bowtie-build and bowtie-inspect are replaced by scripts on PATH. The fake
+# bowtie-build logs its calls and, like bowtie-build -r, writes no .3/.4
+# parts; FAKE_BUILD=fail makes it exit 1, FAKE_BUILD=empty makes it write
+# nothing. The fake bowtie-inspect accepts an index whose .1 part says ok.
+
+BUILD = '''#!/bin/sh
+echo "$@" >> "$FAKE_BOWTIE_LOG"
+for prefix; do :; done
+[ "$FAKE_BUILD" = fail ] && exit 1
+[ "$FAKE_BUILD" = empty ] && exit 0
+for part in 1 2 rev.1 rev.2; do echo ok > "$prefix.$part.ebwt"; done
+exit 0
+'''
+
+INSPECT = '''#!/bin/sh
+grep -q ok "$2.1.ebwt"
+'''
+
+
+@pytest.fixture
+def fake_bowtie(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    for name, text in (('bowtie-build', BUILD), ('bowtie-inspect', INSPECT)):
+        script = bindir / name
+        script.write_text(text)
+        script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    log = tmp_path / 'build.log'
+    monkeypatch.setenv('PATH', f'{bindir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('FAKE_BOWTIE_LOG', str(log))
+    monkeypatch.delenv('FAKE_BUILD', raising=False)
+    genome_fa = tmp_path / 'genome.fa'
+    genome_fa.write_text('>chr1\nACGTACGTAC\n')
+
+    def builds():
+        return len(log.read_text().splitlines()) if log.exists() else 0
+    return str(genome_fa), str(tmp_path / 'idx'), builds
+
+def test_build_and_reuse(fake_bowtie):
+    genome_fa, root, builds = fake_bowtie
+    prefix = ensure_index(genome_fa, root)
+    assert builds() == 1
+    assert len(index_files(prefix)) == 4
+    assert ensure_index(genome_fa, root) == prefix
+    assert builds() == 1
+
+def test_broken_index_rebuilt(fake_bowtie):
+    genome_fa, root, builds = fake_bowtie
+    prefix = ensure_index(genome_fa, root)
+    with open(f'{prefix}.1.ebwt', 'w') as fo:
+        fo.write('truncated\n')
+    assert ensure_index(genome_fa, root) == prefix
+    assert builds() == 2
+
+@pytest.mark.parametrize('mode', ['fail', 'empty'])
+def test_failed_build(fake_bowtie, monkeypatch, mode):
+    genome_fa, root, builds = fake_bowtie
+    monkeypatch.setenv('FAKE_BUILD', mode)
+    with pytest.raises(RuntimeError):
+        ensure_index(genome_fa, root)
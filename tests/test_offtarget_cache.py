@@ -0,0 +1,93 @@
+import os
+import random
+
+import pytest
+
+from solo_gRNA import screen_offtargets, clapse_by_density
+from libs import hit_table
+from libs.hit_table import load_hits
+from libs.genome_store import open_genome
+from libs.guide_cache import GuideCache
+from libs.intervals import IntervalIndex
+
+
+# A cold, a warm and a half-cached run of the same guides must keep the same
+# guides after the density collapse, which depends on the hit order.
+
+SCAFFOLDS = {'chr1': 5000, 'chr2': 5000}
+
+
+@pytest.fixture
+def setup(tmp_path):
+    rng = random.Random(3)
+    genome_fa = tmp_path / 'genome.fa'
+    with open(genome_fa, 'w') as fh:
+        for scaffold, length in SCAFFOLDS.items():
+            fh.write(f'>{scaffold}\n{"".join(rng.choice("ACGT") for _ in range(length))}\n')
+    genome_seqs = open_genome(str(genome_fa), str(tmp_path / 'genome'))
+    rrna_index = IntervalIndex({'chr1': [[0, 200]], 'chr2': [[0, 200]]})
+    exon_index = IntervalIndex({'chr2': [[2000, 3000]]})
+
+    guides = {f'g{i}': ''.join(rng.choice('ACGT') for _ in range(20)) for i in range(60)}
+    #hits crowded into a few hundred bp, in a fixed per guide order
+    lines = {}
+    for _id, spacer in guides.items():
+        lines[_id] = []
+        for _ in range(rng.randint(1, 6)):
+            scaffold = rng.choice(list(SCAFFOLDS))
+            lines[_id].append(f'{_id}\t{rng.choice("+-")}\t{scaffold}\t{rng.randint(1000, 3500)}\t{spacer}\t\n')
+
+    def search(misses):
+        #reports hits in input order, as bowtie with --reorder does
+        return [line for _id in misses for line in lines[_id]]
+
+    def run(guides, cache_path, threads=1, off_target_fa=os.devnull, hits_out=None):
+        cache = GuideCache(str(cache_path), 'key') if cache_path else None
+        kept, hits = screen_offtargets(dict(guides), search, genome_seqs, rrna_index, exon_index, 'NGG',
+            cache=cache, threads=threads, off_target_fa=off_target_fa, hits_out=hits_out)
+        if cache:
+            cache.close()
+        return list(clapse_by_density(kept, hits, input_fa=str(tmp_path / 'input.fa')).items())
+
+    run.search = search
+    return guides, run, tmp_path
+
+def test_cached_runs_match_uncached(setup):
+    guides, run, tmp_path = setup
+    expected = run(guides, None)
+    cache_path = tmp_path / 'cache.sqlite'
+    assert run(guides, cache_path) == expected #cold
+    assert run(guides, cache_path) == expected #warm
+
+    half_path = tmp_path / 'half.sqlite'
+    run({_id: seq for i, (_id, seq) in enumerate(guides.items()) if i % 2}, half_path)
+    assert run(guides, half_path) == expected
+
+def test_chunked_filter_matches_whole(setup, monkeypatch):
+    #hit lines filtered in small chunks, serially or over a pool, discard
+    #the same guides in the same order as one table
+    guides, run, tmp_path = setup
+    whole_fa = tmp_path / 'whole.fa'
+    expected = run(guides, None, off_target_fa=str(whole_fa))
+    assert whole_fa.read_text()
+    monkeypatch.setattr(hit_table, 'HIT_CHUNK', 7)
+    for threads in (1, 2):
+        chunked_fa = tmp_path / f'chunked{threads}.fa'
+        assert run(guides, None, threads, str(chunked_fa)) == expected
+        assert chunked_fa.read_text() == whole_fa.read_text()
+
+def test_hits_out_covers_all_guides(setup):
+    #with cached verdicts the hits file is rewritten with every guide's
+    #hits, in the order a search of all guides reports them
+    guides, run, tmp_path = setup
+    cache_path = tmp_path / 'cache.sqlite'
+    run({_id: seq for i, (_id, seq) in enumerate(guides.items()) if i % 2}, cache_path)
+    hits_out = tmp_path / 'bowtie.csv'
+    hits_out.write_text('stale\t+\tchr1\t1\tACGT\t\n')
+    run(guides, cache_path, hits_out=str(hits_out))
+    expected = load_hits(run.search(guides))
+    written = load_hits(str(hits_out))
+    def rows(hits):
+        return list(zip([hits.guide_ids[g] for g in hits.guide.tolist()], hits.forward.tolist(),
+            [hits.scaffolds[c] for c in hits.scaffold.tolist()], hits.pos.tolist()))
+    assert rows(written) == rows(expected)
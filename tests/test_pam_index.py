@@ -0,0 +1,67 @@
+import random
+from multiprocessing import Pool
+
+from libs.genome_store import open_genome
+from libs.iupac import revcomp
+from libs.pam_index import open_pam_index
+
+
+SCAFFOLDS = {'chr1': 3000, 'chr2': 1500}
+
+
+def write_genome(path):
+    rng = random.Random(5)
+    seqs = {scaffold: ''.join(rng.choice('ACGT') for _ in range(length)) for scaffold, length in SCAFFOLDS.items()}
+    with open(path, 'w') as fh:
+        for scaffold, seq in seqs.items():
+            fh.write(f'>{scaffold}\n{seq}\n')
+    return str(path), seqs
+
+def index_size(genome_fa):
+    genome_seqs = open_genome(genome_fa)
+    return len(open_pam_index(genome_seqs, 'NGG', 20))
+
+def brute_force(seqs, guide, mismatches=3):
+    #(strand, scaffold, position) of the NGG sites within mismatches of guide
+    hits = set()
+    for scaffold, seq in seqs.items():
+        for p in range(len(seq) - 22):
+            if seq[p+21:p+23] == 'GG' and sum(a != b for a, b in zip(seq[p:p+20], guide)) <= mismatches:
+                hits.add(('+', scaffold, p))
+            q = p + 3
+            if seq[p:p+2] == 'CC' and q + 20 <= len(seq) and \
+                    sum(a != b for a, b in zip(revcomp(seq[q:q+20]), guide)) <= mismatches:
+                hits.add(('-', scaffold, q))
+    return hits
+
+def test_search_matches_brute_force(tmp_path):
+    genome_fa, seqs = write_genome(tmp_path / 'genome.fa')
+    pam_index = open_pam_index(open_genome(genome_fa), 'NGG', 20)
+    rng = random.Random(6)
+    guides = {}
+    sites = [(scaffold, p) for scaffold, seq in seqs.items() for p in range(len(seq) - 22)
+        if seq[p+21:p+23] == 'GG']
+    for i in range(20):
+        #spacers of real sites, with up to 3 substitutions, half of them
+        #reverse complemented to match the - strand
+        scaffold, p = rng.choice(sites)
+        guide = seqs[scaffold][p:p+20]
+        guide = list(guide if i % 2 else revcomp(guide))
+        for j in rng.sample(range(20), rng.randint(0, 3)):
+            guide[j] = rng.choice('ACGT')
+        guides[f'g{i}'] = ''.join(guide)
+    found = {}
+    for line in pam_index.search(guides):
+        _id, strand, scaffold, pos = line.split('\t')[:4]
+        found.setdefault(_id, set()).add((strand, scaffold, int(pos)))
+    for _id, guide in guides.items():
+        assert found.get(_id, set()) == brute_force(seqs, guide)
+    assert sum(len(hits) for hits in found.values()) >= 10
+
+def test_concurrent_builds(tmp_path):
+    genome_fa, seqs = write_genome(tmp_path / 'genome.fa')
+    open_genome(genome_fa).close()
+    with Pool(processes=4) as pool:
+        sizes = pool.map(index_size, [genome_fa] * 8)
+    assert len(set(sizes)) == 1 and sizes[0] > 0
+    assert not [f for f in tmp_path.iterdir() if f.name.endswith('.tmp')]
@@ -0,0 +1,22 @@
+import pytest
+
+from libs.process_bam import BamParser
+from libs.process_bin import BinBuilder
+
+
+# region_count against bin_count, one fetch per bin, on reads with M, I, D,
+# N and S operations.
+
+SETTINGS = [(100, 50, 50), (150, 30, 45), (60, 60, 0), (250, 100, 1000)]
+
+
+@pytest.mark.parametrize('bin_len, overlap, maxSoftClip', SETTINGS)
+def test_region_count_matches_bin_count(synthetic_bam, bin_len, overlap, maxSoftClip):
+    bam, bed = synthetic_bam
+    builder = BinBuilder(bed, bin_len, overlap)
+    bins = [tuple(bin_) for chunk in builder.chunks(37) for bin_ in chunk]
+    parser = BamParser(bam, maxSoftClip)
+    expected = [parser.bin_count(bin_) for bin_ in bins]
+    assert parser.region_count(bins) == expected
+    assert sum(expected) > 0
+    parser.close()